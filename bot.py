@@ -1,724 +1,1268 @@
-﻿import asyncio
-import random
-import string
-from datetime import datetime, timedelta
-from telethon import TelegramClient, events, Button
-import configparser
-import logging
-import requests
-import json
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Load configuration
-config = configparser.ConfigParser()
-with open('config.ini') as fh:
-    config.read_file(fh)
-# or:
-config.read('config.ini')
-# Bot settings
-API_ID = config['Telegram']['API_ID']
-API_HASH = config['Telegram']['api_hash']
-BOT_TOKEN = config['Telegram']['BOT_TOKEN']
-ADMIN_IDS = [int(id) for id in config['Telegram']['admin_ids'].split(',')]
-
-# Outline VPN settings
-OUTLINE_API_URL = config.get('Outline', 'api_url')
-OUTLINE_API_CERT = config.get('Outline', 'api_cert', fallback=None)
-OUTLINE_SERVERS = {
-    'EU': {'api_url': OUTLINE_API_URL, 'cert': OUTLINE_API_CERT},
-    'US': {'api_url': config.get('Outline', 'us_api_url', fallback=''), 'cert': config.get('Outline', 'us_api_cert', fallback=None)},
-    'ASIA': {'api_url': config.get('Outline', 'asia_api_url', fallback=''), 'cert': config.get('Outline', 'asia_api_cert', fallback=None)}
-}
-
-# Pricing and referral
-PRICES = {
-    '1week': 100,
-    '1month': 300,
-    '3months': 800,
-}
-REFERRAL_BONUS = 50
-REFERRAL_PERCENT = 0.1
-
-# Database simulation
-users_db = {}
-keys_db = {}
-payments_db = {}
-
-# Initialize Telegram client
-client = TelegramClient('vpn_bot', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
-
-class OutlineManager:
-    @staticmethod
-    async def create_key(server, days):
-        """Create new Outline key"""
-        if server not in OUTLINE_SERVERS or not OUTLINE_SERVERS[server]['api_url']:
-            return None
-            
-        try:
-            headers = {'Content-Type': 'application/json'}
-            data = {
-                'method': 'create_key',
-                'params': {
-                    'name': f"VPN_{days}days_{datetime.now().strftime('%Y%m%d')}",
-                    'data_limit': {'bytes': 100000000000},  # 100GB
-                    'expiry_date': int((datetime.now() + timedelta(days=days)).timestamp())
-                }
-            }
-            
-            verify = OUTLINE_SERVERS[server]['cert'] or True
-            response = requests.post(
-                OUTLINE_SERVERS[server]['api_url'],
-                headers=headers,
-                data=json.dumps(data),
-                verify=verify,
-                timeout=10
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    'key_id': result['result']['id'],
-                    'access_key': result['result']['access_key'],
-                    'server': server,
-                    'expiry': datetime.now() + timedelta(days=days)
-                }
-            logger.error(f"Outline API error: {response.text}")
-            return None
-            
-        except Exception as e:
-            logger.error(f"Outline connection error: {str(e)}")
-            return None
-
-    @staticmethod
-    async def delete_key(key_id, server):
-        """Delete Outline key"""
-        try:
-            headers = {'Content-Type': 'application/json'}
-            data = {
-                'method': 'delete_key',
-                'params': {'id': key_id}
-            }
-            
-            verify = OUTLINE_SERVERS[server]['cert'] or True
-            response = requests.post(
-                OUTLINE_SERVERS[server]['api_url'],
-                headers=headers,
-                data=json.dumps(data),
-                verify=verify,
-                timeout=10
-            )
-            
-            return response.status_code == 200
-            
-        except Exception as e:
-            logger.error(f"Outline delete error: {str(e)}")
-            return False
-
-def format_timedelta(td):
-    """Format timedelta to human-readable string"""
-    days = td.days
-    hours, remainder = divmod(td.seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
-    
-    parts = []
-    if days > 0:
-        parts.append(f"{days} д.")
-    if hours > 0:
-        parts.append(f"{hours} ч.")
-    if minutes > 0 or not parts:
-        parts.append(f"{minutes} мин.")
-    
-    return " ".join(parts)
-
-async def generate_vpn_key(server, duration):
-    """Generate VPN key (Outline or fallback)"""
-    outline_key = await OutlineManager.create_key(server, duration)
-    if outline_key:
-        return outline_key['access_key'], outline_key['expiry']
-    
-    # Fallback if Outline not available
-    prefix = {'EU': 'EU', 'US': 'US', 'ASIA': 'AS'}.get(server, 'GL')
-    key = f"{prefix}-{''.join(random.choices(string.ascii_uppercase + string.digits, k=10))}"
-    expiry_date = datetime.now() + timedelta(days=duration)
-    return key, expiry_date
-
-async def send_key_to_user(user_id, key_info):
-    """Send VPN key to user with instructions"""
-    server, key, expiry = key_info
-    message = (
-        "✅ Ваш VPN ключ активирован!\n\n"
-        f"🌍 Сервер: {server}\n"
-        f"🔑 Ключ: `{key}`\n"
-        f"📅 Срок действия: {expiry.strftime('%d.%m.%Y %H:%M')}\n\n"
-        "📲 Как подключиться:\n"
-        "1. Скачайте Outline Client (https://getoutline.org)\n"
-        "2. Нажмите '+' → 'Добавить ключ доступа'\n"
-        "3. Вставьте этот ключ\n"
-        "4. Включите VPN переключателем\n\n"
-        "⚠️ Ключ привязан к вашему аккаунту Telegram!"
-    )
-    
-    try:
-        await client.send_message(user_id, message, parse_mode='md')
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send key to user {user_id}: {e}")
-        return False
-
-async def get_user_keys(user_id):
-    """Get active keys for user"""
-    active_keys = []
-    for key, data in keys_db.items():
-        if data['user_id'] == user_id and data['expiry'] > datetime.now():
-            remaining = data['expiry'] - datetime.now()
-            active_keys.append((
-                data['server'],
-                key,
-                data['expiry'],
-                remaining
-            ))
-    
-    active_keys.sort(key=lambda x: x[2])
-    return active_keys
-
-# ===================== HANDLERS ===================== #
-
-@client.on(events.NewMessage(pattern='/start'))
-async def start_handler(event):
-    """Handle /start command"""
-    user_id = event.sender_id
-    is_new_user = user_id not in users_db
-    
-    # Check referral
-    ref_id = None
-    if event.message.text.startswith('/start ref'):
-        try:
-            ref_id = int(event.message.text.split()[2])
-            if ref_id == user_id:
-                await event.respond("❌ Нельзя использовать собственную реферальную ссылку!")
-                ref_id = None
-        except (IndexError, ValueError):
-            pass
-    
-    if is_new_user:
-        users_db[user_id] = {
-            'registered': datetime.now(),
-            'purchases': 0,
-            'balance': 0,
-            'referral_by': ref_id,
-            'referrals': [],
-            'earned_from_refs': 0,
-            'awaiting_broadcast': False
-        }
-        
-        # Add referral bonus
-        if ref_id and ref_id in users_db:
-            users_db[ref_id]['balance'] += REFERRAL_BONUS
-            users_db[ref_id]['referrals'].append(user_id)
-            await client.send_message(
-                ref_id,
-                f"🎉 Новый реферал! Вам начислено {REFERRAL_BONUS} руб. бонуса.\n"
-                f"Ваш баланс: {users_db[ref_id]['balance']} руб."
-            )
-    elif ref_id and not users_db[user_id].get('referral_by'):
-        users_db[user_id]['referral_by'] = ref_id
-        if ref_id in users_db:
-            users_db[ref_id]['referrals'].append(user_id)
-    
-    buttons = [
-        [Button.inline("🛒 Купить VPN", b"buy_vpn")],
-        [Button.inline("🔑 Мои ключи", b"my_keys")],
-        [Button.inline("👥 Рефералы", b"referral")],
-        [Button.inline("ℹ️ Информация", b"info")],
-        [Button.inline("📞 Поддержка", b"support")]
-    ]
-    
-    if user_id in ADMIN_IDS:
-        buttons.append([Button.inline("👑 Админ панель", b"admin_panel")])
-    
-    message = "🔒 Добро пожаловать в VPN сервис!\n\nЗдесь вы можете приобрести доступ к быстрым и безопасным VPN серверам по всему миру."
-    
-    if is_new_user:
-        message += "\n\n🎉 Вам доступен бонус за регистрацию!"
-    
-    await event.respond(message, buttons=buttons)
-
-@client.on(events.CallbackQuery(data=b"my_keys"))
-async def my_keys_handler(event):
-    """Show user's active keys"""
-    user_id = event.sender_id
-    active_keys = await get_user_keys(user_id)
-    
-    if not active_keys:
-        await event.answer("У вас нет активных ключей.", alert=True)
-        return
-    
-    messages = []
-    for i, (server, key, expiry, remaining) in enumerate(active_keys, 1):
-        messages.append(
-            f"{i}. 🌍 {server} | 🔑 {key[:4]}...{key[-4:]}\n"
-            f"   📅 До {expiry.strftime('%d.%m.%Y')}\n"
-            f"   ⏳ Осталось: {format_timedelta(remaining)}\n"
-        )
-    
-    message_chunks = []
-    current_chunk = "🔑 Ваши активные ключи:\n\n"
-    for msg in messages:
-        if len(current_chunk) + len(msg) > 4000:
-            message_chunks.append(current_chunk)
-            current_chunk = msg
-        else:
-            current_chunk += msg
-    
-    if current_chunk:
-        message_chunks.append(current_chunk)
-    
-    for chunk in message_chunks:
-        await event.respond(chunk)
-    
-    await event.answer()
-
-@client.on(events.CallbackQuery(data=b"referral"))
-async def referral_handler(event):
-    """Show referral information"""
-    user_id = event.sender_id
-    user_data = users_db.get(user_id, {})
-    
-    ref_link = f"https://t.me/{BOT_TOKEN.split(':')[0]}?start=ref_{user_id}"
-    ref_count = len(user_data.get('referrals', []))
-    earned = user_data.get('earned_from_refs', 0)
-    balance = user_data.get('balance', 0)
-    
-    message = (
-        "👥 Реферальная система\n\n"
-        f"🔗 Ваша ссылка: {ref_link}\n\n"
-        f"👥 Приглашено: {ref_count} пользователей\n"
-        f"💰 Заработано: {earned} руб.\n"
-        f"💳 Текущий баланс: {balance} руб.\n\n"
-        "За каждого приглашенного друга вы получаете:\n"
-        f"- {REFERRAL_BONUS} руб. сразу после регистрации\n"
-        f"- {REFERRAL_PERCENT*100}% от его первой покупки\n\n"
-        "Баланс можно использовать для оплаты VPN!"
-    )
-    
-    buttons = [
-        [Button.inline("🔙 Назад", b"main_menu")],
-        [Button.url("📢 Поделиться", f"https://t.me/share/url?url={ref_link}&text=Присоединяйся%20к%20VPN%20сервису!")]
-    ]
-    
-    await event.edit(message, buttons=buttons)
-
-@client.on(events.CallbackQuery(data=b"buy_vpn"))
-async def buy_vpn_handler(event):
-    """Show VPN purchase menu"""
-    buttons = [
-        [Button.inline("🇪🇺 Европа", b"server_EU")],
-        [Button.inline("🇺🇸 США", b"server_US")],
-        [Button.inline("🇨🇳 Азия", b"server_ASIA")],
-        [Button.inline("🔙 Назад", b"main_menu")]
-    ]
-    await event.edit(
-        "🌍 Выберите регион VPN сервера:",
-        buttons=buttons
-    )
-
-@client.on(events.CallbackQuery(data=b"info"))
-async def info_handler(event):
-    """Show service info"""
-    await event.edit(
-        "ℹ️ Информация о VPN сервисе:\n\n"
-        "🔒 Безопасность: 256-bit шифрование\n"
-        "🚀 Скорость: до 1 Гбит/с\n"
-        "🌍 Сервера в 15+ странах\n"
-        "📱 Поддержка всех устройств\n\n"
-        "Наши преимущества:\n"
-        "- Без логов\n"
-        "- Поддержка 24/7\n"
-        "- Быстрая настройка",
-        buttons=[[Button.inline("🔙 Назад", b"main_menu")]]
-    )
-
-@client.on(events.CallbackQuery(data=b"support"))
-async def support_handler(event):
-    """Show support info"""
-    await event.edit(
-        "📞 Поддержка\n\n"
-        "По всем вопросам обращайтесь к @vpn_support\n"
-        "или на email: support@vpnservice.example\n\n"
-        "Мы онлайн 24/7!",
-        buttons=[[Button.inline("🔙 Назад", b"main_menu")]]
-    )
-
-@client.on(events.CallbackQuery(data=b"admin_panel"))
-async def admin_panel_handler(event):
-    """Show admin panel"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    total_users = len(users_db)
-    active_keys = sum(1 for k in keys_db.values() if k['expiry'] > datetime.now())
-    total_sales = sum(u['purchases'] for u in users_db.values())
-    
-    buttons = [
-        [Button.inline("📊 Статистика", b"admin_stats")],
-        [Button.inline("🔑 Сгенерировать ключи", b"admin_gen_keys")],
-        [Button.inline("📩 Рассылка", b"admin_broadcast")],
-        [Button.inline("🔙 Назад", b"main_menu")]
-    ]
-    
-    await event.edit(
-        f"👑 Админ панель\n\n"
-        f"👥 Пользователей: {total_users}\n"
-        f"🔑 Активных ключей: {active_keys}\n"
-        f"💰 Всего продаж: {total_sales}",
-        buttons=buttons
-    )
-
-@client.on(events.CallbackQuery(data=b"admin_stats"))
-async def admin_stats_handler(event):
-    """Show detailed stats"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    today = datetime.now().date()
-    new_today = sum(1 for u in users_db.values() if u['registered'].date() == today)
-    sales_today = sum(1 for p in payments_db.values() if p['date'].date() == today)
-    
-    await event.edit(
-        f"📊 Детальная статистика\n\n"
-        f"👥 Новых сегодня: {new_today}\n"
-        f"💰 Продаж сегодня: {sales_today}\n"
-        f"💳 Общий доход: {sum(p['amount'] for p in payments_db.values())} руб.",
-        buttons=[[Button.inline("🔙 В админку", b"admin_panel")]]
-    )
-
-@client.on(events.CallbackQuery(data=b"admin_gen_keys"))
-async def admin_gen_keys_handler(event):
-    """Generate test keys"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    buttons = [
-        [Button.inline("🇪🇺 Европа (7 дней)", b"gen_key_EU_7")],
-        [Button.inline("🇺🇸 США (30 дней)", b"gen_key_US_30")],
-        [Button.inline("🇨🇳 Азия (90 дней)", b"gen_key_ASIA_90")],
-        [Button.inline("🔙 Назад", b"admin_panel")]
-    ]
-    
-    await event.edit(
-        "🔑 Генерация тестовых ключей Outline\n\n"
-        "Выберите сервер и срок действия:",
-        buttons=buttons
-    )
-
-@client.on(events.CallbackQuery(data=b"gen_key_"))
-async def gen_key_handler(event):
-    """Handle key generation"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    _, _, server, days = event.data.decode().split("_")
-    days = int(days)
-    
-    outline_key = await OutlineManager.create_key(server, days)
-    if outline_key:
-        key_info = (server, outline_key['access_key'], outline_key['expiry'])
-        await send_key_to_user(event.sender_id, key_info)
-        await event.answer("✅ Ключ создан и отправлен вам в ЛС!", alert=True)
-    else:
-        await event.answer("❌ Ошибка при создании ключа!", alert=True)
-    
-    await admin_panel_handler(event)
-
-@client.on(events.CallbackQuery(data=b"admin_broadcast"))
-async def admin_broadcast_handler(event):
-    """Initiate broadcast"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    await event.edit(
-        "📩 Рассылка сообщений\n\n"
-        "Отправьте мне сообщение, которое нужно разослать всем пользователям.\n"
-        "Можно использовать форматирование (Markdown).\n\n"
-        "❌ Отмена: /cancel",
-        buttons=[[Button.inline("🔙 Назад", b"admin_panel")]]
-    )
-    
-    users_db[event.sender_id]['awaiting_broadcast'] = True
-
-@client.on(events.NewMessage(pattern='/cancel'))
-async def cancel_handler(event):
-    """Cancel any operation"""
-    user_id = event.sender_id
-    if user_id in users_db and users_db[user_id].get('awaiting_broadcast'):
-        users_db[user_id]['awaiting_broadcast'] = False
-        await event.respond(
-            "❌ Рассылка отменена.",
-            buttons=[[Button.inline("🔙 В админку", b"admin_panel")]]
-        )
-
-@client.on(events.NewMessage())
-async def message_handler(event):
-    """Handle broadcast message"""
-    user_id = event.sender_id
-    if user_id not in ADMIN_IDS:
-        return
-    
-    if users_db.get(user_id, {}).get('awaiting_broadcast'):
-        users_db[user_id]['awaiting_broadcast'] = False
-        message = event.message
-        
-        buttons = [
-            [Button.inline("✅ Подтвердить", f"confirm_broadcast_{message.id}")],
-            [Button.inline("❌ Отменить", b"admin_panel")]
-        ]
-        
-        await event.respond(
-            "📩 Предпросмотр рассылки:\n\n"
-            "Сообщение будет отправлено всем пользователям:",
-            buttons=buttons
-        )
-        await event.forward_to(event.sender_id)
-
-@client.on(events.CallbackQuery(data=b"confirm_broadcast_"))
-async def confirm_broadcast_handler(event):
-    """Confirm and send broadcast"""
-    if event.sender_id not in ADMIN_IDS:
-        await event.answer("Доступ запрещен!")
-        return
-    
-    try:
-        message_id = int(event.data.decode().split("_")[2])
-    except (IndexError, ValueError):
-        await event.answer("Ошибка: неверный ID сообщения")
-        return
-    
-    try:
-        message = await client.get_messages(event.sender_id, ids=message_id)
-    except Exception as e:
-        await event.answer(f"Ошибка: {str(e)}")
-        return
-    
-    success = 0
-    failed = 0
-    total = len(users_db)
-    
-    progress_msg = await event.respond(
-        f"⏳ Начата рассылка для {total} пользователей...\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Ошибок: {failed}"
-    )
-    
-    for user_id in users_db:
-        if user_id == event.sender_id:
-            continue
-        
-        try:
-            await client.send_message(
-                user_id,
-                "📢 Важное обновление от VPN сервиса:\n\n" + message.text,
-                parse_mode='md'
-            )
-            success += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {e}")
-            failed += 1
-        
-        if (success + failed) % 10 == 0:
-            try:
-                await progress_msg.edit(
-                    f"⏳ Рассылка для {total} пользователей...\n"
-                    f"✅ Успешно: {success}\n"
-                    f"❌ Ошибок: {failed}"
-                )
-            except:
-                pass
-    
-    await progress_msg.edit(
-        f"📩 Рассылка завершена!\n\n"
-        f"👥 Всего пользователей: {total}\n"
-        f"✅ Успешно отправлено: {success}\n"
-        f"❌ Не удалось отправить: {failed}\n\n"
-        f"Процент доставки: {success/max(1,total)*100:.1f}%",
-        buttons=[[Button.inline("🔙 В админку", b"admin_panel")]]
-    )
-    await event.answer()
-
-@client.on(events.CallbackQuery())
-async def callback_handler(event):
-    """Handle all other callbacks"""
-    data = event.data.decode('utf-8')
-    
-    if data.startswith("server_"):
-        server = data.split("_")[1]
-        buttons = [
-            [Button.inline("1 неделя - 100 руб.", f"duration_{server}_7")],
-            [Button.inline("1 месяц - 300 руб.", f"duration_{server}_30")],
-            [Button.inline("3 месяца - 800 руб.", f"duration_{server}_90")],
-            [Button.inline("🔙 Назад", b"buy_vpn")]
-        ]
-        await event.edit(
-            f"Вы выбрали сервер: {server}\n\n"
-            "Выберите срок действия:",
-            buttons=buttons
-        )
-    
-    elif data.startswith("duration_"):
-        _, server, days = data.split("_")
-        days = int(days)
-        user_id = event.sender_id
-        user_balance = users_db.get(user_id, {}).get('balance', 0)
-        price = PRICES[f"{days//7}week"] if days != 90 else PRICES["3months"]
-        
-        if user_balance >= price:
-            buttons = [
-                [Button.inline(f"💳 Оплатить с баланса ({user_balance} руб.)", f"pay_balance_{server}_{days}")],
-                [Button.inline("💳 Оплатить другим способом", f"payment_{server}_{days}")],
-                [Button.inline("🔙 Назад", f"server_{server}")]
-            ]
-        else:
-            buttons = [
-                [Button.inline("💳 Оплатить", f"payment_{server}_{days}")],
-                [Button.inline("🔙 Назад", f"server_{server}")]
-            ]
-        
-        await event.edit(
-            f"💳 Оплата доступа к VPN\n\n"
-            f"🌍 Сервер: {server}\n"
-            f"⏳ Срок: {days} дней\n"
-            f"💰 Сумма: {price} руб.\n"
-            f"💳 Ваш баланс: {user_balance} руб.\n\n"
-            "Выберите способ оплаты:",
-            buttons=buttons
-        )
-    
-    elif data.startswith("pay_balance_"):
-        _, _, server, days = data.split("_")
-        days = int(days)
-        user_id = event.sender_id
-        price = PRICES[f"{days//7}week"] if days != 90 else PRICES["3months"]
-        
-        if users_db[user_id]['balance'] >= price:
-            users_db[user_id]['balance'] -= price
-            users_db[user_id]['purchases'] += 1
-            
-            key, expiry = await generate_vpn_key(server, days)
-            keys_db[key] = {
-                'user_id': user_id,
-                'server': server,
-                'expiry': expiry,
-                'generated': datetime.now()
-            }
-            
-            ref_id = users_db[user_id].get('referral_by')
-            if ref_id and ref_id in users_db:
-                bonus = int(price * REFERRAL_PERCENT)
-                users_db[ref_id]['balance'] += bonus
-                users_db[ref_id]['earned_from_refs'] += bonus
-                await client.send_message(
-                    ref_id,
-                    f"💰 Ваш реферал совершил покупку! Вам начислено {bonus} руб.\n"
-                    f"Ваш баланс: {users_db[ref_id]['balance']} руб."
-                )
-            
-            await send_key_to_user(user_id, (server, key, expiry))
-            await event.edit(
-                "✅ Оплата прошла успешно! VPN ключ отправлен вам в личные сообщения.",
-                buttons=[[Button.inline("🔙 В меню", b"main_menu")]]
-            )
-        else:
-            await event.answer("❌ Недостаточно средств на балансе!", alert=True)
-    
-    elif data.startswith("payment_"):
-        _, server, days = data.split("_")
-        days = int(days)
-        
-        payment_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        payments_db[payment_id] = {
-            'user_id': event.sender_id,
-            'server': server,
-            'duration': days,
-            'amount': PRICES[f"{days//7}week"] if days != 90 else PRICES["3months"],
-            'date': datetime.now(),
-            'completed': False
-        }
-        
-        buttons = [
-            [Button.url("💳 Оплатить", f"https://example.com/pay/{payment_id}")],
-            [Button.inline("✅ Я оплатил", f"check_payment_{payment_id}")],
-            [Button.inline("🔙 Назад", f"server_{server}")]
-        ]
-        
-        await event.edit(
-            f"💳 Оплата доступа к VPN\n\n"
-            f"🌍 Сервер: {server}\n"
-            f"⏳ Срок: {days} дней\n"
-            f"💰 Сумма: {payments_db[payment_id]['amount']} руб.\n\n"
-            "После оплаты нажмите кнопку 'Я оплатил'",
-            buttons=buttons
-        )
-    
-    elif data.startswith("check_payment_"):
-        payment_id = data.split("_")[2]
-        payment = payments_db.get(payment_id)
-        
-        if not payment:
-            await event.answer("Платеж не найден!", alert=True)
-            return
-        
-        if payment['completed']:
-            await event.answer("Этот платеж уже обработан!", alert=True)
-            return
-        
-        if random.random() < 0.8:  # Simulate payment check
-            payment['completed'] = True
-            user_id = payment['user_id']
-            key, expiry = await generate_vpn_key(payment['server'], payment['duration'])
-            
-            keys_db[key] = {
-                'user_id': user_id,
-                'server': payment['server'],
-                'expiry': expiry,
-                'generated': datetime.now()
-            }
-            
-            users_db[user_id]['purchases'] += 1
-            
-            ref_id = users_db[user_id].get('referral_by')
-            if ref_id and ref_id in users_db:
-                bonus = int(payment['amount'] * REFERRAL_PERCENT)
-                users_db[ref_id]['balance'] += bonus
-                users_db[ref_id]['earned_from_refs'] += bonus
-                await client.send_message(
-                    ref_id,
-                    f"💰 Ваш реферал совершил покупку! Вам начислено {bonus} руб.\n"
-                    f"Ваш баланс: {users_db[ref_id]['balance']} руб."
-                )
-            
-            await send_key_to_user(user_id, (payment['server'], key, expiry))
-            await event.answer("✅ Платеж подтвержден! Ключ отправлен вам в личные сообщения.", alert=True)
-            await event.delete()
-        else:
-            await event.answer("❌ Платеж еще не поступил. Попробуйте позже.", alert=True)
-    
-    elif data == "main_menu":
-        await start_handler(event)
-
-async def main():
-    """Main function"""
-    logger.info("Starting VPN Bot...")
-    await client.run_until_disconnected()
-
-if __name__ == '__main__':
-    client.loop.run_until_complete(main())
+﻿import asyncio
+import gc
+import os
+import random
+import re
+import string
+import tempfile
+import time
+from datetime import datetime, timedelta
+from telethon import TelegramClient, events, Button
+from telethon.errors import MessageNotModifiedError
+import logging
+from outline import OutlineTransport
+from storage import create_storage
+from keyindex import KeyIndex
+from reaper import ExpiryReaper
+from broadcast import BroadcastEngine
+from router import CallbackRouter
+from stats import Stats
+from health import HealthMonitor
+from keypool import KeyPool
+from payments import PaymentService, create_provider
+from locks import LockRegistry, SingleFlight
+from cluster import ClusterError, ClusterNode, dispatch_update
+from menus import MenuRegistry
+from metrics import Metrics
+from logs import contextual, setup_logging
+from referrals import ReferralStore, ReferralNotifier
+from bulkkeys import BulkKeyJob, WRITERS
+from outbox import Outbox, KEY_DELIVERY
+from usage import UsageTable, UsageSync
+from settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+# Pricing and referral
+PRICES = {
+    '1week': 100,
+    '1month': 300,
+    '3months': 800,
+}
+DURATION_PRICES = {
+    7: PRICES['1week'],
+    30: PRICES['1month'],
+    90: PRICES['3months'],
+}
+REFERRAL_BONUS = 50
+REFERRAL_PERCENT = 0.1
+# Share of a purchase paid to each referrer level, nearest first
+REFERRAL_LEVELS = [REFERRAL_PERCENT]
+KEYS_PAGE_SIZE = 10
+BULK_KEYS_MAX = 1000
+# Owner of admin-generated keys in storage, no Telegram user has this id
+BULK_KEYS_OWNER = 0
+
+# Cluster settings, passed by cluster.py to sharded worker processes
+node = ClusterNode.from_env()
+
+key_index = KeyIndex()
+usage = UsageTable()
+router = CallbackRouter()
+user_locks = LockRegistry()
+# Purchases are joined only while running: every menu step edits the same
+# message, so a finished purchase must not block buying the same item again
+purchases = SingleFlight(ttl=0)
+
+# Built by create_app() from settings
+settings = None
+client = None
+storage = None
+stats = None
+outline_transport = None
+health = None
+reaper = None
+key_pool = None
+broadcast_engine = None
+payment_service = None
+metrics = None
+referral_store = None
+referral_notifier = None
+outbox = None
+usage_sync = None
+
+# (handler, event builder) pairs registered on the client by create_app()
+event_handlers = []
+
+def on_event(builder):
+    """Register a Telegram event handler, like client.on()"""
+    def decorator(func):
+        event_handlers.append((func, builder))
+        return func
+    return decorator
+
+class OutlineManager:
+    @staticmethod
+    def key_params(days):
+        """Name, data limit and expiry for a key valid for `days`"""
+        return {
+            'name': f"VPN_{days}days_{datetime.now().strftime('%Y%m%d')}",
+            'data_limit': {'bytes': 100000000000},  # 100GB
+            'expiry_date': int((datetime.now() + timedelta(days=days)).timestamp())
+        }
+
+    @staticmethod
+    async def create_key(server, days=None):
+        """Create new Outline key, without `days` an unassigned pool key"""
+        if not outline_transport.servers.get(server, {}).get('api_url'):
+            return None
+            
+        try:
+            data = {
+                'method': 'create_key',
+                'params': OutlineManager.key_params(days) if days else {'name': "VPN_pool"}
+            }
+            
+            status, result = await outline_transport.post(server, data)
+            
+            if status == 200:
+                return {
+                    'key_id': result['result']['id'],
+                    'access_key': result['result']['access_key'],
+                    'server': server,
+                    'expiry': datetime.now() + timedelta(days=days or 0)
+                }
+            logger.error("Outline API error: %s", result, extra={'server': server})
+            return None
+            
+        except Exception as e:
+            logger.error("Outline connection error: %s", e, extra={'server': server})
+            return None
+
+    @staticmethod
+    async def update_key(key_id, server, days):
+        """Assign name, data limit and expiry to an existing key"""
+        if server not in outline_transport.servers:
+            return False
+        
+        try:
+            data = {
+                'method': 'update_key',
+                'params': {'id': key_id, **OutlineManager.key_params(days)}
+            }
+            
+            status, _ = await outline_transport.post(server, data)
+            return status == 200
+            
+        except Exception as e:
+            logger.error("Outline update error: %s", e, extra={'server': server})
+            return False
+
+    @staticmethod
+    async def delete_key(key_id, server):
+        """Delete Outline key"""
+        if not outline_transport.servers.get(server, {}).get('api_url'):
+            return False
+        
+        try:
+            data = {
+                'method': 'delete_key',
+                'params': {'id': key_id}
+            }
+            
+            status, _ = await outline_transport.post(server, data)
+            return status == 200
+            
+        except Exception as e:
+            logger.error("Outline delete error: %s", e, extra={'server': server})
+            return False
+
+def price_for(days):
+    """Get price for key duration in days"""
+    return DURATION_PRICES[days]
+
+def format_timedelta(td):
+    """Format timedelta to human-readable string"""
+    days = td.days
+    hours, remainder = divmod(td.seconds, 3600)
+    minutes, _ = divmod(remainder, 60)
+    
+    parts = []
+    if days > 0:
+        parts.append(f"{days} д.")
+    if hours > 0:
+        parts.append(f"{hours} ч.")
+    if minutes > 0 or not parts:
+        parts.append(f"{minutes} мин.")
+    
+    return " ".join(parts)
+
+def format_bytes(size):
+    """Format a byte count to a human-readable string"""
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+@node.on_services
+async def issue_outline_key(region, days):
+    """Claim a pooled key or create one on the best server of a region"""
+    nodes = health.ranked(region)
+    outline_key = await key_pool.claim(nodes, days)
+    if not outline_key:
+        # A half-open server gets only the one trial call
+        server = next((server for server in nodes if health.acquire(server)), None)
+        if server is not None:
+            outline_key = await OutlineManager.create_key(server, days)
+    return outline_key
+
+@node.on_services
+async def issue_bulk_key(region, days):
+    """Create an admin key, leaving the purchase pool alone"""
+    server = next((server for server in health.ranked(region) if health.acquire(server)), None)
+    if server is None:
+        return None
+    outline_key = await OutlineManager.create_key(server, days)
+    if outline_key:
+        # Stored like a sold key, so the reaper revokes it when it expires
+        await store_key(outline_key['access_key'], BULK_KEYS_OWNER, region, outline_key['expiry'],
+                        outline_key['key_id'], outline_key['server'])
+    return outline_key
+
+async def generate_vpn_key(server, duration):
+    """Generate VPN key (Outline or fallback)"""
+    outline_key = await issue_outline_key(server, duration)
+    if outline_key:
+        return outline_key['access_key'], outline_key['expiry'], outline_key['key_id'], outline_key['server']
+    
+    # Fallback if Outline not available
+    prefix = {'EU': 'EU', 'US': 'US', 'ASIA': 'AS'}.get(server, 'GL')
+    key = f"{prefix}-{''.join(random.choices(string.ascii_uppercase + string.digits, k=10))}"
+    expiry_date = datetime.now() + timedelta(days=duration)
+    return key, expiry_date, None, None
+
+async def send_key_to_user(user_id, key_info):
+    """Send VPN key to user with instructions"""
+    server, key, expiry = key_info
+    message = (
+        "✅ Ваш VPN ключ активирован!\n\n"
+        f"🌍 Сервер: {server}\n"
+        f"🔑 Ключ: `{key}`\n"
+        f"📅 Срок действия: {expiry.strftime('%d.%m.%Y %H:%M')}\n\n"
+        "📲 Как подключиться:\n"
+        "1. Скачайте Outline Client (https://getoutline.org)\n"
+        "2. Нажмите '+' → 'Добавить ключ доступа'\n"
+        "3. Вставьте этот ключ\n"
+        "4. Включите VPN переключателем\n\n"
+        "⚠️ Ключ привязан к вашему аккаунту Telegram!"
+    )
+    
+    try:
+        await outbox.send_message(user_id, message, priority=KEY_DELIVERY, parse_mode='md')
+        return True
+    except Exception as e:
+        logger.error("Failed to send key to user %s: %s", user_id, e, extra={'user_id': user_id})
+        return False
+
+async def store_key(key, user_id, server, expiry, key_id=None, node=None):
+    """Save issued key and index it"""
+    await storage.put('keys', key, {
+        'user_id': user_id,
+        'server': server,
+        'node': node,
+        'key_id': key_id,
+        'expiry': expiry,
+        'generated': datetime.now()
+    })
+    key_index.add(key, user_id, server, expiry)
+    await schedule_expiry(key, user_id, server, expiry, key_id, node)
+
+@node.on_services
+async def schedule_expiry(key, user_id, server, expiry, key_id=None, node=None):
+    """Hand a new key to the reaper and usage accounting"""
+    if key not in key_index:
+        key_index.add(key, user_id, server, expiry)
+    if key_id is not None:
+        usage.track(key, node or server, key_id)
+    reaper.notify(expiry)
+
+@node.on_services
+async def key_usage(keys):
+    """Transferred bytes of keys, None for keys without usage data"""
+    return [usage.get(key) for key in keys]
+
+@node.on_services
+async def record_registration(when):
+    await stats.record_registration(when)
+
+@node.on_services
+async def record_sale(server, revenue=0):
+    await stats.record_sale(server, revenue)
+
+@node.on_shard
+async def add_referral(ref_id, user_id, bonus=0):
+    """Link a new referral to the referrer and pay the signup bonus"""
+    async with user_locks[ref_id]:
+        referrer = await storage.get('users', ref_id)
+        if not referrer or not await referral_store.add(ref_id, user_id):
+            return
+        if not bonus:
+            return
+        referrer['balance'] += bonus
+        await storage.put('users', ref_id, referrer)
+    
+    referral_notifier.notify(ref_id, 'signup', bonus, referrer['balance'])
+
+@node.on_shard
+async def credit_referrer(ref_id, bonus):
+    """Pay a referral bonus for a purchase to the referrer"""
+    async with user_locks[ref_id]:
+        referrer = await storage.get('users', ref_id)
+        if not referrer:
+            return
+        referrer['balance'] += bonus
+        referrer['earned_from_refs'] += bonus
+        await storage.put('users', ref_id, referrer)
+    
+    referral_notifier.notify(ref_id, 'purchase', bonus, referrer['balance'])
+
+async def credit_referrers(user_id, amount):
+    """Pay every referrer level its share of a purchase"""
+    ancestors = await referral_store.ancestors(user_id, len(REFERRAL_LEVELS))
+    for ref_id, percent in zip(ancestors, REFERRAL_LEVELS):
+        bonus = int(amount * percent)
+        if bonus:
+            await credit_referrer(ref_id, bonus)
+
+def forget_usage(expired):
+    """Give usage slots of expired keys back"""
+    for key, _ in expired:
+        usage.discard(key)
+
+async def load_key_index():
+    """Build key index from storage and queue expired keys for revocation"""
+    now = datetime.now()
+    for key, data in await storage.find('keys', expiry__gt=now):
+        if node.owns(data['user_id']):
+            key_index.add(key, data['user_id'], data['server'], data['expiry'])
+            # Usage is synced and kept by the services process only
+            if node.runs_services and data.get('key_id') is not None:
+                usage.track(key, data.get('node') or data['server'], data['key_id'])
+    expired = await storage.find('keys', expiry__le=now) if node.runs_services else []
+    for key, data in expired:
+        reaper.schedule(key, data['server'])
+    logger.info(f"Loaded {len(key_index)} active keys, {len(expired)} expired keys to revoke")
+
+# ===================== MENUS ===================== #
+
+menus = MenuRegistry()
+
+DURATION_LABELS = {7: "1 неделя", 30: "1 месяц", 90: "3 месяца"}
+
+@menus.menu('main')
+def build_main_menu(is_admin, is_new_user):
+    buttons = [
+        [Button.inline("🛒 Купить VPN", b"buy_vpn")],
+        [Button.inline("🔑 Мои ключи", b"my_keys")],
+        [Button.inline("👥 Рефералы", b"referral")],
+        [Button.inline("ℹ️ Информация", b"info")],
+        [Button.inline("📞 Поддержка", b"support")]
+    ]
+    
+    if is_admin:
+        buttons.append([Button.inline("👑 Админ панель", b"admin_panel")])
+    
+    message = "🔒 Добро пожаловать в VPN сервис!\n\nЗдесь вы можете приобрести доступ к быстрым и безопасным VPN серверам по всему миру."
+    
+    if is_new_user:
+        message += "\n\n🎉 Вам доступен бонус за регистрацию!"
+    
+    return message, buttons
+
+def main_menu(user_id, is_new_user=False):
+    """Main menu message and markup"""
+    return menus.get('main', user_id in settings.admin_ids, is_new_user)
+
+@menus.static('buy_vpn')
+def build_buy_vpn_menu():
+    buttons = [
+        [Button.inline("🇪🇺 Европа", b"server_EU")],
+        [Button.inline("🇺🇸 США", b"server_US")],
+        [Button.inline("🇨🇳 Азия", b"server_ASIA")],
+        [Button.inline("🔙 Назад", b"main_menu")]
+    ]
+    return "🌍 Выберите регион VPN сервера:", buttons
+
+@menus.static('info')
+def build_info_menu():
+    return (
+        "ℹ️ Информация о VPN сервисе:\n\n"
+        "🔒 Безопасность: 256-bit шифрование\n"
+        "🚀 Скорость: до 1 Гбит/с\n"
+        "🌍 Сервера в 15+ странах\n"
+        "📱 Поддержка всех устройств\n\n"
+        "Наши преимущества:\n"
+        "- Без логов\n"
+        "- Поддержка 24/7\n"
+        "- Быстрая настройка",
+        [[Button.inline("🔙 Назад", b"main_menu")]]
+    )
+
+@menus.static('support')
+def build_support_menu():
+    return (
+        "📞 Поддержка\n\n"
+        "По всем вопросам обращайтесь к @vpn_support\n"
+        "или на email: support@vpnservice.example\n\n"
+        "Мы онлайн 24/7!",
+        [[Button.inline("🔙 Назад", b"main_menu")]]
+    )
+
+@menus.menu('server')
+def build_server_menu(server):
+    buttons = [
+        [Button.inline(f"{label} - {price_for(days)} руб.", f"duration_{server}_{days}")]
+        for days, label in DURATION_LABELS.items()
+    ]
+    buttons.append([Button.inline("🔙 Назад", b"buy_vpn")])
+    return f"Вы выбрали сервер: {server}\n\nВыберите срок действия:", buttons
+
+@menus.menu('duration')
+def build_duration_menu(server, days, from_balance):
+    if from_balance:
+        buttons = [
+            [Button.inline("💳 Оплатить с баланса", f"pay_balance_{server}_{days}")],
+            [Button.inline("💳 Оплатить другим способом", f"payment_{server}_{days}")],
+            [Button.inline("🔙 Назад", f"server_{server}")]
+        ]
+    else:
+        buttons = [
+            [Button.inline("💳 Оплатить", f"payment_{server}_{days}")],
+            [Button.inline("🔙 Назад", f"server_{server}")]
+        ]
+    
+    message = (
+        f"💳 Оплата доступа к VPN\n\n"
+        f"🌍 Сервер: {server}\n"
+        f"⏳ Срок: {days} дней\n"
+        f"💰 Сумма: {price_for(days)} руб.\n"
+        "💳 Ваш баланс: {balance} руб.\n\n"
+        "Выберите способ оплаты:"
+    )
+    return message, buttons
+
+@menus.static('admin_panel')
+def build_admin_panel_menu():
+    buttons = [
+        [Button.inline("📊 Статистика", b"admin_stats")],
+        [Button.inline("🔑 Сгенерировать ключи", b"admin_gen_keys")],
+        [Button.inline("📩 Рассылка", b"admin_broadcast")],
+        [Button.inline("🔙 Назад", b"main_menu")]
+    ]
+    message = (
+        "👑 Админ панель\n\n"
+        "👥 Пользователей: {users}\n"
+        "🔑 Активных ключей: {active_keys}\n"
+        "💰 Всего продаж: {sales}"
+    )
+    return message, buttons
+
+@menus.static('admin_gen_keys')
+def build_admin_gen_keys_menu():
+    buttons = [
+        [Button.inline("🇪🇺 Европа (7 дней)", b"gen_key_EU_7")],
+        [Button.inline("🇺🇸 США (30 дней)", b"gen_key_US_30")],
+        [Button.inline("🇨🇳 Азия (90 дней)", b"gen_key_ASIA_90")],
+        [Button.inline("📦 Массовая генерация", b"bulk_keys_help")],
+        [Button.inline("🔙 Назад", b"admin_panel")]
+    ]
+    return "🔑 Генерация тестовых ключей Outline\n\nВыберите сервер и срок действия:", buttons
+
+@menus.menu('keys_page')
+def build_keys_page_menu(page, pages):
+    buttons = []
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(Button.inline("⬅️", f"keys_page_{page - 1}"))
+        nav.append(Button.inline(f"{page + 1}/{pages}", f"keys_page_{page}"))
+        if page < pages - 1:
+            nav.append(Button.inline("➡️", f"keys_page_{page + 1}"))
+        buttons.append(nav)
+    buttons.append([Button.inline("🔙 Назад", b"main_menu")])
+    return "🔑 Ваши активные ключи ({count}):\n\n", buttons
+
+# Single "back" buttons shown under dynamic messages
+@menus.static('back_main')
+def build_back_main():
+    return None, [[Button.inline("🔙 Назад", b"main_menu")]]
+
+@menus.static('to_main')
+def build_to_main():
+    return None, [[Button.inline("🔙 В меню", b"main_menu")]]
+
+@menus.static('back_admin')
+def build_back_admin():
+    return None, [[Button.inline("🔙 Назад", b"admin_panel")]]
+
+@menus.static('to_admin')
+def build_to_admin():
+    return None, [[Button.inline("🔙 В админку", b"admin_panel")]]
+
+# ===================== MESSAGE FILTERS ===================== #
+
+# Admins whose next message is a broadcast draft
+broadcast_drafts = set()
+
+START_PATTERN = re.compile(r'^/start(?:@\w+)?(?:\s|$)')
+CANCEL_PATTERN = re.compile(r'^/cancel(?:@\w+)?$')
+# Deep link payload of the referral link is `ref_<id>`
+REF_PATTERN = re.compile(r'^/start(?:@\w+)?\s+ref[_\s](\d+)')
+# /genkeys <count> <region,region> <days> [csv|json]
+BULK_KEYS_PATTERN = re.compile(r'^/genkeys(?:@\w+)?(?:\s+(\d+)\s+([\w,]+)\s+(\d+)(?:\s+(csv|json))?)?\s*$', re.IGNORECASE)
+
+def is_admin(event):
+    """Cheap pre-filter: message from an admin"""
+    return event.sender_id in settings.admin_ids
+
+def is_drafting_broadcast(event):
+    """Cheap pre-filter: sender is an admin preparing a broadcast"""
+    return event.sender_id in broadcast_drafts
+
+def is_broadcast_draft(event):
+    """Cheap pre-filter: non-command message from a drafting admin"""
+    return event.sender_id in broadcast_drafts and not event.raw_text.startswith('/')
+
+# ===================== HANDLERS ===================== #
+
+@on_event(events.NewMessage(incoming=True, pattern=START_PATTERN))
+async def start_handler(event):
+    """Handle /start command"""
+    user_id = event.sender_id
+    
+    # Check referral
+    ref_id = None
+    match = REF_PATTERN.match(event.message.text)
+    if match:
+        ref_id = int(match.group(1))
+        if ref_id == user_id:
+            await event.respond("❌ Нельзя использовать собственную реферальную ссылку!")
+            ref_id = None
+    
+    referred = False
+    async with user_locks[user_id]:
+        user = await storage.get('users', user_id)
+        is_new_user = user is None
+        if is_new_user:
+            user = {
+                'registered': datetime.now(),
+                'purchases': 0,
+                'balance': 0,
+                'referral_by': ref_id,
+                'earned_from_refs': 0
+            }
+            await storage.put('users', user_id, user)
+            await record_registration(user['registered'])
+            referred = ref_id is not None
+        elif ref_id and not user.get('referral_by'):
+            user['referral_by'] = ref_id
+            await storage.put('users', user_id, user)
+            referred = True
+    
+    # Referrer is updated outside the user's lock, locks are never nested
+    if referred:
+        await add_referral(ref_id, user_id, REFERRAL_BONUS if is_new_user else 0)
+    
+    message, buttons = main_menu(user_id, is_new_user)
+    await event.respond(message, buttons=buttons)
+
+@router.route('my_keys')
+async def my_keys_handler(event):
+    """Show user's active keys"""
+    await show_keys_page(event, 0)
+
+@router.route('keys_page', int)
+async def keys_page_handler(event, page):
+    """Switch page of user's active keys"""
+    await show_keys_page(event, page)
+
+async def show_keys_page(event, page):
+    """Edit the message to one page of user's active keys"""
+    user_id = event.sender_id
+    now = datetime.now()
+    count = key_index.user_key_count(user_id, now)
+    
+    if not count:
+        await event.answer("У вас нет активных ключей.", alert=True)
+        return
+    
+    pages = (count + KEYS_PAGE_SIZE - 1) // KEYS_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    offset = page * KEYS_PAGE_SIZE
+    message, buttons = menus.render('keys_page', page, pages, count=count)
+    keys = key_index.user_keys_page(user_id, now, offset, KEYS_PAGE_SIZE)
+    traffic = await key_usage([key for key, _, _ in keys])
+    for i, ((key, server, expiry), used) in enumerate(zip(keys, traffic), offset + 1):
+        message += (
+            f"{i}. 🌍 {server} | 🔑 {key[:4]}...{key[-4:]}\n"
+            f"   📅 До {expiry.strftime('%d.%m.%Y')}\n"
+            f"   ⏳ Осталось: {format_timedelta(expiry - now)}\n"
+        )
+        if used is not None:
+            message += f"   📶 Трафик: {format_bytes(used)}\n"
+    
+    try:
+        await event.edit(message, buttons=buttons)
+    except MessageNotModifiedError:
+        # Page indicator pressed, nothing changed
+        await event.answer()
+
+@router.route('referral')
+async def referral_handler(event):
+    """Show referral information"""
+    user_id = event.sender_id
+    user_data = await storage.get('users', user_id) or {}
+    
+    ref_link = f"https://t.me/{settings.bot_token.split(':')[0]}?start=ref_{user_id}"
+    ref_count = referral_store.count(user_id)
+    earned = user_data.get('earned_from_refs', 0)
+    balance = user_data.get('balance', 0)
+    
+    message = (
+        "👥 Реферальная система\n\n"
+        f"🔗 Ваша ссылка: {ref_link}\n\n"
+        f"👥 Приглашено: {ref_count} пользователей\n"
+        f"💰 Заработано: {earned} руб.\n"
+        f"💳 Текущий баланс: {balance} руб.\n\n"
+        "За каждого приглашенного друга вы получаете:\n"
+        f"- {REFERRAL_BONUS} руб. сразу после регистрации\n"
+        f"- {REFERRAL_PERCENT*100}% от его первой покупки\n\n"
+        "Баланс можно использовать для оплаты VPN!"
+    )
+    
+    buttons = [
+        [Button.inline("🔙 Назад", b"main_menu")],
+        [Button.url("📢 Поделиться", f"https://t.me/share/url?url={ref_link}&text=Присоединяйся%20к%20VPN%20сервису!")]
+    ]
+    
+    await event.edit(message, buttons=buttons)
+
+@router.route('buy_vpn')
+async def buy_vpn_handler(event):
+    """Show VPN purchase menu"""
+    message, buttons = menus.get('buy_vpn')
+    await event.edit(message, buttons=buttons)
+
+@router.route('info')
+async def info_handler(event):
+    """Show service info"""
+    message, buttons = menus.get('info')
+    await event.edit(message, buttons=buttons)
+
+@router.route('support')
+async def support_handler(event):
+    """Show support info"""
+    message, buttons = menus.get('support')
+    await event.edit(message, buttons=buttons)
+
+@node.on_services
+async def admin_snapshot():
+    """Counters shown in the admin panels"""
+    now = datetime.now()
+    return {
+        'total': stats.total,
+        'active_keys': key_index.active_count(now),
+        'today': stats.day(now),
+        'history': stats.history(7, now),
+        'health': health.summary(),
+        'pending': (payment_service.pending_count, payment_service.pending_revenue),
+        'usage': usage.servers
+    }
+
+@router.route('admin_panel')
+async def admin_panel_handler(event):
+    """Show admin panel"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    snapshot = await admin_snapshot()
+    message, buttons = menus.render(
+        'admin_panel',
+        users=snapshot['total']['users'],
+        active_keys=snapshot['active_keys'],
+        sales=snapshot['total']['sales']
+    )
+    await event.edit(message, buttons=buttons)
+
+@router.route('admin_stats')
+async def admin_stats_handler(event):
+    """Show detailed stats"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    snapshot = await admin_snapshot()
+    today = snapshot['today']
+    total = snapshot['total']
+    pending_count, pending_revenue = snapshot['pending']
+    
+    servers = "".join(
+        f"   {server}: {data['sales']} продаж, {data['revenue']} руб.\n"
+        for server, data in sorted(today['servers'].items())
+    )
+    nodes = "".join(
+        f"   {server}: {'❌' if is_open else '✅'} "
+        f"{f'{latency * 1000:.0f} мс' if latency is not None else '—'}, ошибок {error_rate:.0%}\n"
+        for server, (latency, error_rate, is_open) in sorted(snapshot['health'].items())
+    )
+    traffic = "".join(
+        f"   {server}: {data['keys']} ключей, {format_bytes(data['bytes'])}\n"
+        for server, data in sorted(snapshot['usage'].items())
+    ) or "   нет данных\n"
+    history = "".join(
+        f"   {date.strftime('%d.%m')}: +{day['registrations']} 👥, {day['sales']} продаж, {day['revenue']} руб.\n"
+        for date, day in snapshot['history']
+    )
+    
+    await event.edit(
+        f"📊 Детальная статистика\n\n"
+        f"👥 Новых сегодня: {today['registrations']}\n"
+        f"💰 Продаж сегодня: {today['sales']}\n"
+        f"💵 Доход сегодня: {today['revenue']} руб.\n"
+        f"{servers}"
+        f"💳 Общий доход: {total['revenue']} руб.\n"
+        f"⏳ Ожидают оплаты: {pending_count} на {pending_revenue} руб.\n"
+        f"🗑 Просрочено счетов: {total['abandoned']} на {total['abandoned_amount']} руб.\n\n"
+        f"🖥 Серверы Outline:\n{nodes}\n"
+        f"📶 Трафик:\n{traffic}\n"
+        f"📅 За 7 дней:\n{history}",
+        buttons=menus.markup('to_admin')
+    )
+
+@router.route('admin_gen_keys')
+async def admin_gen_keys_handler(event):
+    """Generate test keys"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    message, buttons = menus.get('admin_gen_keys')
+    await event.edit(message, buttons=buttons)
+
+@router.route('gen_key', str, int)
+async def gen_key_handler(event, server, days):
+    """Handle key generation"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    # Tracked like bulk keys, so it is revoked when it expires
+    outline_key = await issue_bulk_key(server, days)
+    if outline_key:
+        key_info = (server, outline_key['access_key'], outline_key['expiry'])
+        await send_key_to_user(event.sender_id, key_info)
+        await event.answer("✅ Ключ создан и отправлен вам в ЛС!", alert=True)
+    else:
+        await event.answer("❌ Ошибка при создании ключа!", alert=True)
+    
+    await admin_panel_handler(event)
+
+BULK_KEYS_USAGE = (
+    "📦 Массовая генерация ключей\n\n"
+    "Отправьте команду:\n"
+    "/genkeys <количество> <регионы> <дней> [csv|json]\n\n"
+    "Например: /genkeys 100 EU,US 30 csv\n"
+    f"Не больше {BULK_KEYS_MAX} ключей за раз. Ключи придут файлом."
+)
+
+# Admin -> running bulk key generation task
+bulk_jobs = {}
+
+@router.route('bulk_keys_help')
+async def bulk_keys_help_handler(event):
+    """Explain bulk key generation"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    await event.edit(BULK_KEYS_USAGE, buttons=menus.markup('back_admin'))
+
+@on_event(events.NewMessage(incoming=True, pattern=BULK_KEYS_PATTERN, func=is_admin))
+async def bulk_keys_handler(event):
+    """Start bulk key generation in the background"""
+    admin_id = event.sender_id
+    match = event.pattern_match
+    if not match.group(1):
+        await event.respond(BULK_KEYS_USAGE)
+        return
+    
+    count, days = int(match.group(1)), int(match.group(3))
+    regions = [region.upper() for region in match.group(2).split(',') if region]
+    fmt = (match.group(4) or 'csv').lower()
+    unknown = [region for region in regions if not settings.outline.regions.get(region)]
+    if unknown or not regions:
+        await event.respond(f"❌ Неизвестные регионы: {', '.join(unknown) or '-'}")
+        return
+    if not 0 < count <= BULK_KEYS_MAX or not 0 < days <= 3650:
+        await event.respond(f"❌ Количество: 1-{BULK_KEYS_MAX}, срок: 1-3650 дней")
+        return
+    if admin_id in bulk_jobs:
+        await event.respond("⏳ Предыдущая генерация еще не завершена")
+        return
+    
+    progress_msg = await event.respond(f"⏳ Генерация ключей: 0/{count}")
+    task = asyncio.create_task(run_bulk_keys(admin_id, progress_msg.id, regions, count, days, fmt))
+    bulk_jobs[admin_id] = task
+    task.add_done_callback(lambda _: bulk_jobs.pop(admin_id, None))
+
+async def run_bulk_keys(admin_id, progress_msg_id, regions, count, days, fmt):
+    """Issue keys into a temporary file and send it to the admin"""
+    async def report(job, final):
+        await outbox.edit_message(
+            admin_id,
+            progress_msg_id,
+            f"{'✅ Генерация завершена' if final else '⏳ Генерация ключей'}: {job.processed}/{job.count}\n"
+            f"🔑 Создано: {job.created}\n"
+            f"❌ Ошибок: {job.failed}"
+        )
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, f"keys_{'_'.join(regions)}_{days}d_{datetime.now():%Y%m%d_%H%M%S}.{fmt}")
+            with open(path, 'w', newline='', encoding='utf-8') as fh:
+                job = BulkKeyJob(
+                    issue_bulk_key,
+                    regions,
+                    count,
+                    days,
+                    WRITERS[fmt](fh),
+                    report,
+                    concurrency=settings.outline.max_in_flight
+                )
+                await job.run()
+            if job.created:
+                await outbox.send_file(
+                    admin_id,
+                    path,
+                    caption=f"🔑 Ключи Outline: {job.created} шт., {days} дней ({', '.join(regions)})",
+                    force_document=True
+                )
+    except Exception as e:
+        logger.error("Bulk key generation failed: %s", e, extra={'user_id': admin_id})
+        await outbox.send_message(admin_id, f"❌ Ошибка генерации ключей: {e}")
+
+@router.route('admin_broadcast')
+async def admin_broadcast_handler(event):
+    """Initiate broadcast"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    await event.edit(
+        "📩 Рассылка сообщений\n\n"
+        "Отправьте мне сообщение, которое нужно разослать всем пользователям.\n"
+        "Можно использовать форматирование (Markdown).\n\n"
+        "❌ Отмена: /cancel",
+        buttons=menus.markup('back_admin')
+    )
+    
+    broadcast_drafts.add(event.sender_id)
+
+@on_event(events.NewMessage(incoming=True, pattern=CANCEL_PATTERN, func=is_drafting_broadcast))
+async def cancel_handler(event):
+    """Cancel any operation"""
+    if event.sender_id in broadcast_drafts:
+        broadcast_drafts.discard(event.sender_id)
+        await event.respond(
+            "❌ Рассылка отменена.",
+            buttons=menus.markup('to_admin')
+        )
+
+@on_event(events.NewMessage(incoming=True, func=is_broadcast_draft))
+async def message_handler(event):
+    """Handle broadcast message"""
+    user_id = event.sender_id
+    if user_id in broadcast_drafts:
+        broadcast_drafts.discard(user_id)
+        message = event.message
+        
+        buttons = [
+            [Button.inline("✅ Подтвердить", f"confirm_broadcast_{message.id}")],
+            [Button.inline("❌ Отменить", b"admin_panel")]
+        ]
+        
+        await event.respond(
+            "📩 Предпросмотр рассылки:\n\n"
+            "Сообщение будет отправлено всем пользователям:",
+            buttons=buttons
+        )
+        await event.forward_to(event.sender_id)
+
+@router.route('confirm_broadcast', int)
+async def confirm_broadcast_handler(event, message_id):
+    """Confirm and send broadcast"""
+    if event.sender_id not in settings.admin_ids:
+        await event.answer("Доступ запрещен!")
+        return
+    
+    try:
+        message = await client.get_messages(event.sender_id, ids=message_id)
+    except Exception as e:
+        await event.answer(f"Ошибка: {str(e)}")
+        return
+    
+    broadcast_id = f"{event.sender_id}_{message_id}"
+    text = "📢 Важное обновление от VPN сервиса:\n\n" + message.text
+    if not await start_broadcast(broadcast_id, event.sender_id, text):
+        await event.answer("Эта рассылка уже запущена!", alert=True)
+        return
+    await event.answer()
+
+@node.on_services
+async def start_broadcast(broadcast_id, admin_id, text):
+    """Start a broadcast unless it already ran"""
+    if broadcast_engine.is_running(broadcast_id) or await storage.get('broadcasts', broadcast_id):
+        return False
+    
+    total = await storage.count('users')
+    progress_msg = await outbox.send_message(
+        admin_id,
+        f"⏳ Начата рассылка для {total} пользователей...\n"
+        "✅ Успешно: 0\n"
+        "❌ Ошибок: 0"
+    )
+    
+    await broadcast_engine.start(broadcast_id, admin_id, text, progress_msg.id)
+    return True
+
+async def report_broadcast_progress(broadcast, final):
+    """Update broadcast progress message"""
+    admin_id = broadcast['admin_id']
+    total = broadcast['total']
+    success = broadcast['success']
+    failed = broadcast['failed']
+    
+    if not final:
+        await outbox.edit_message(
+            admin_id,
+            broadcast['progress_msg_id'],
+            f"⏳ Рассылка для {total} пользователей...\n"
+            f"✅ Успешно: {success}\n"
+            f"❌ Ошибок: {failed}"
+        )
+        return
+    
+    await outbox.edit_message(
+        admin_id,
+        broadcast['progress_msg_id'],
+        f"📩 Рассылка завершена!\n\n"
+        f"👥 Всего пользователей: {total}\n"
+        f"✅ Успешно отправлено: {success}\n"
+        f"❌ Не удалось отправить: {failed}\n\n"
+        f"Процент доставки: {success/max(1,total)*100:.1f}%",
+        buttons=menus.markup('to_admin')
+    )
+
+@router.route('server', str)
+async def server_handler(event, server):
+    """Show duration menu for server"""
+    message, buttons = menus.get('server', server)
+    await event.edit(message, buttons=buttons)
+
+@router.route('duration', str, int)
+async def duration_handler(event, server, days):
+    """Show payment options"""
+    user = await storage.get('users', event.sender_id) or {}
+    balance = user.get('balance', 0)
+    message, buttons = menus.render('duration', server, days, balance >= price_for(days), balance=balance)
+    await event.edit(message, buttons=buttons)
+
+@router.route('pay_balance', str, int)
+async def pay_balance_handler(event, server, days):
+    """Pay for VPN from balance"""
+    # Repeated taps on the same button join the purchase already running
+    # and get its outcome instead of buying twice
+    request = (event.sender_id, event.message_id, event.data)
+    error = await purchases.run(request, lambda: buy_from_balance(event.sender_id, server, days))
+    if error:
+        await event.answer(error, alert=True)
+        return
+    try:
+        await event.edit(
+            "✅ Оплата прошла успешно! VPN ключ отправлен вам в личные сообщения.",
+            buttons=menus.markup('to_main')
+        )
+    except MessageNotModifiedError:
+        # A repeated tap, the first one already edited the message
+        await event.answer()
+
+async def buy_from_balance(user_id, server, days):
+    """Charge balance and send a key, returns an error message or None"""
+    price = price_for(days)
+    
+    async with user_locks[user_id]:
+        user = await storage.get('users', user_id)
+        if not user or user['balance'] < price:
+            return "❌ Недостаточно средств на балансе!"
+        user['balance'] -= price
+        user['purchases'] += 1
+        await storage.put('users', user_id, user, durable=True)
+    
+    try:
+        key, expiry, key_id, node = await generate_vpn_key(server, days)
+    except (ClusterError, asyncio.TimeoutError, ConnectionError) as e:
+        # The services process didn't answer, give the money back
+        logger.error("Balance purchase failed, refunding %s руб.: %s", price, e, extra={'user_id': user_id})
+        async with user_locks[user_id]:
+            user = await storage.get('users', user_id)
+            user['balance'] += price
+            user['purchases'] -= 1
+            await storage.put('users', user_id, user, durable=True)
+        return "❌ Не удалось выдать ключ, средства возвращены на баланс. Попробуйте позже."
+    await store_key(key, user_id, server, expiry, key_id, node)
+    await record_sale(server)
+    await credit_referrers(user_id, price)
+    
+    await send_key_to_user(user_id, (server, key, expiry))
+    return None
+
+@router.route('payment', str, int)
+async def payment_handler(event, server, days):
+    """Create external payment"""
+    async with user_locks[event.sender_id]:
+        payment_id, payment = await create_invoice(event.sender_id, server, days, price_for(days))
+    valid_until = datetime.fromtimestamp(payment_service.expires_at(payment))
+    
+    buttons = [
+        [Button.url("💳 Оплатить", payment_service.payment_url(payment_id, payment['amount']))],
+        [Button.inline("✅ Я оплатил", f"check_payment_{payment_id}")],
+        [Button.inline("🔙 Назад", f"server_{server}")]
+    ]
+    
+    await event.edit(
+        f"💳 Оплата доступа к VPN\n\n"
+        f"🌍 Сервер: {server}\n"
+        f"⏳ Срок: {days} дней\n"
+        f"💰 Сумма: {payment['amount']} руб.\n"
+        f"🕒 Счет действителен до {valid_until.strftime('%H:%M')}\n\n"
+        "После оплаты ключ придет автоматически.\n"
+        "Проверить статус можно кнопкой 'Я оплатил'",
+        buttons=buttons
+    )
+
+@router.route('check_payment', str)
+async def check_payment_handler(event, payment_id):
+    """Show external payment status"""
+    payment = await payment_status(payment_id)
+    
+    if not payment:
+        await event.answer("Платеж не найден!", alert=True)
+        return
+    
+    if payment['completed']:
+        await event.answer("Этот платеж уже обработан!", alert=True)
+    elif payment.get('paid'):
+        await event.answer("✅ Платеж подтвержден! Ключ будет отправлен вам в личные сообщения.", alert=True)
+    else:
+        await event.answer("⏳ Платеж еще не поступил. Ключ придет автоматически после оплаты.", alert=True)
+
+async def fulfill_payment(payment_id, payment):
+    """Issue key for a confirmed payment and deliver it"""
+    # The key is saved on the payment before anything else, so a retry
+    # delivers the same key instead of issuing another one
+    if payment.get('key') is None:
+        key, expiry, key_id, node = await generate_vpn_key(payment['server'], payment['duration'])
+        payment['key'] = {'access_key': key, 'expiry': expiry, 'key_id': key_id, 'node': node}
+        await storage.put('payments', payment_id, payment, durable=True)
+    await deliver_payment(payment['user_id'], payment_id, payment)
+
+@node.on_shard
+async def deliver_payment(user_id, payment_id, payment):
+    """Apply the purchase in the shard that owns the user and send the key"""
+    issued = payment['key']
+    key = issued['access_key']
+    # A retry finds the key stored and only sends it again, so the sale
+    # and referral bonuses are never counted twice
+    if await storage.get('keys', key) is None:
+        await store_key(key, user_id, payment['server'], issued['expiry'], issued['key_id'], issued['node'])
+        async with user_locks[user_id]:
+            user = await storage.get('users', user_id)
+            if user:
+                user['purchases'] += 1
+                await storage.put('users', user_id, user)
+        await record_sale(payment['server'], payment['amount'])
+        await credit_referrers(user_id, payment['amount'])
+    
+    await send_key_to_user(user_id, (payment['server'], key, issued['expiry']))
+
+@node.on_services
+async def create_invoice(user_id, server, days, amount):
+    return await payment_service.create(user_id, server, days, amount)
+
+@node.on_services
+async def payment_status(payment_id):
+    return await storage.get('payments', payment_id)
+
+@router.route('main_menu')
+async def main_menu_handler(event):
+    """Return to main menu"""
+    message, buttons = main_menu(event.sender_id)
+    await event.edit(message, buttons=buttons)
+
+@on_event(events.CallbackQuery())
+async def callback_handler(event):
+    """Dispatch all callbacks through the router"""
+    await router.dispatch(event)
+
+def create_app(app_settings=None, telegram_client=None, payment_provider=None):
+    """Build bot components and register handlers on the client.
+    
+    Nothing connects here. A client and a payment provider can be
+    injected (e.g. offline fakes for tests), otherwise they are created
+    from settings and the client is started by main().
+    """
+    global settings, client, storage, stats, outline_transport, health
+    global reaper, key_pool, broadcast_engine, payment_service, metrics
+    global referral_store, referral_notifier, outbox, usage_sync
+    
+    settings = app_settings or load_settings()
+    outline = settings.outline
+    client = telegram_client or TelegramClient(
+        node.session,
+        settings.api_id,
+        settings.api_hash,
+        receive_updates=not node.sharded  # sharded processes get updates from the ingress
+    )
+    if node.sharded and settings.storage_backend == 'journal':
+        # Each process would append to and compact the same journal files
+        raise ValueError("Storage backend 'journal' can't be shared by cluster processes")
+    storage = create_storage(settings.storage_backend, settings.storage_path)
+    stats = Stats(storage)
+    outline_transport = OutlineTransport(
+        outline.servers,
+        connect_timeout=outline.connect_timeout,
+        read_timeout=outline.read_timeout,
+        max_in_flight=outline.max_in_flight
+    )
+    health = HealthMonitor(
+        outline_transport,
+        outline.regions,
+        interval=outline.probe_interval,
+        failure_threshold=outline.failure_threshold,
+        reset_timeout=outline.reset_timeout
+    )
+    key_index.listeners = [forget_usage]
+    if node.runs_services:
+        # Only the services process revokes keys, shards would queue them forever
+        reaper = ExpiryReaper(key_index, storage, OutlineManager.delete_key, concurrency=outline.reaper_concurrency)
+    key_pool = KeyPool(
+        storage,
+        OutlineManager.create_key,
+        OutlineManager.update_key,
+        outline.servers,
+        health.acquire,
+        low=outline.pool_low,
+        high=outline.pool_high
+    )
+    # The send rate is a limit of the bot, split between cluster processes
+    outbox = Outbox(client, rate=settings.send_rate / (node.shards + 1 if node.sharded else 1),
+                    chat_interval=settings.chat_send_interval)
+    broadcast_engine = BroadcastEngine(
+        outbox,
+        storage,
+        report_broadcast_progress,
+        rate=settings.broadcast_rate,
+        concurrency=settings.broadcast_concurrency
+    )
+    usage_sync = UsageSync(
+        outline_transport,
+        usage,
+        outline.servers,
+        health.is_available,
+        interval=outline.usage_interval
+    )
+    referral_store = ReferralStore(storage, node.owns)
+    referral_notifier = ReferralNotifier(outbox.send_message)
+    payments = settings.payments
+    payment_service = PaymentService(
+        storage,
+        payment_provider or create_provider(payments.provider, payments.url),
+        fulfill_payment,
+        poll_interval=payments.poll_interval,
+        webhook_host=payments.webhook_host,
+        webhook_port=payments.webhook_port,
+        webhook_path=payments.webhook_path,
+        webhook_secret=payments.webhook_secret,
+        ttl=payments.ttl,
+        on_expire=lambda payment_id, payment: stats.record_abandoned(payment['amount'], payment['date'])
+    )
+    
+    # Workers of a cluster listen on the ports after the services process
+    metrics_port = settings.metrics_port
+    if metrics_port and node.role == 'worker':
+        metrics_port += node.shard + 1
+    metrics = Metrics(settings.metrics_host, metrics_port)
+    outline_transport.listeners.append(metrics.observe_outline)
+    metrics.counter('bot_broadcast_messages_total', 'Broadcast messages by result', ['result'],
+                    func=lambda: {('sent',): broadcast_engine.sent, ('failed',): broadcast_engine.failed})
+    metrics.counter('bot_flood_waits_total', 'FloodWait errors of outgoing messages',
+                    func=lambda: outbox.flood_waits)
+    metrics.gauge('bot_outbox_pending', 'Outgoing messages waiting to be sent',
+                  func=lambda: len(outbox))
+    if node.runs_services:
+        metrics.gauge('bot_key_pool_size', 'Pre-created keys per server', ['server'],
+                      func=lambda: {(server,): key_pool.size(server) for server in outline.servers})
+        metrics.gauge('bot_pending_payments', 'Open unpaid invoices',
+                      func=lambda: payment_service.pending_count)
+        metrics.gauge('bot_pending_revenue', 'Amount of open unpaid invoices',
+                      func=lambda: payment_service.pending_revenue)
+    
+    def instrument(route, handler):
+        return metrics.instrument(route, contextual(route, handler))
+    
+    router.wrap(instrument)
+    for handler, builder in event_handlers:
+        client.add_event_handler(instrument(handler.__name__, handler), builder)
+    return client
+
+async def main(app_settings=None):
+    """Main function"""
+    started = time.monotonic()
+    logger.info(f"Starting VPN Bot ({node.role})...")
+    if client is None:
+        create_app(app_settings)
+    if not node.offline:
+        await client.start(bot_token=settings.bot_token)
+    await storage.open()
+    await load_key_index()
+    await referral_store.load()
+    outbox.start()
+    referral_notifier.start()
+    await metrics.start()
+    tasks = []
+    if node.runs_services:
+        await stats.load()
+        tasks.append(asyncio.create_task(usage_sync.run()))
+        tasks.append(asyncio.create_task(reaper.run()))
+        tasks.append(asyncio.create_task(health.run()))
+        await key_pool.load()
+        tasks.append(asyncio.create_task(key_pool.run()))
+        await payment_service.start()
+        await broadcast_engine.resume_pending()
+    # Documents and indexes loaded at startup live for the whole run,
+    # keep them out of full garbage collections
+    gc.freeze()
+    logger.info(f"Started in {time.monotonic() - started:.2f}s")
+    try:
+        if node.role == 'worker':
+            await node.serve(lambda message: dispatch_update(client, message))
+        elif node.sharded:
+            await node.serve()
+        else:
+            await client.run_until_disconnected()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await payment_service.stop()
+        await referral_notifier.stop()
+        await outbox.stop()
+        await metrics.stop()
+        await outline_transport.close()
+        await storage.close()
+
+if __name__ == '__main__':
+    app_settings = load_settings()
+    setup_logging(app_settings.log_level, app_settings.log_format)
+    asyncio.run(main(app_settings))
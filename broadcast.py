@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from outbox import BROADCAST, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastEngine:
+    """Sends a message to all users with rate limiting and resume support.
+
+    Recipients are processed in chunks by a bounded pool of senders. After
+    each chunk the position is saved to storage, so a broadcast interrupted
+    by a restart continues where it stopped.
+    """
+
+    def __init__(self, outbox, storage, on_progress, rate=25, concurrency=10,
+                 chunk_size=200, progress_interval=5):
+        self.outbox = outbox
+        self.storage = storage
+        self.on_progress = on_progress
+        self.limiter = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.sent = 0
+        self.failed = 0
+        self._tasks = {}
+
+    def is_running(self, broadcast_id):
+        return broadcast_id in self._tasks
+
+    async def start(self, broadcast_id, admin_id, text, progress_msg_id):
+        """Start a new broadcast in the background"""
+        if self.is_running(broadcast_id) or await self.storage.get('broadcasts', broadcast_id):
+            return False
+        doc = {
+            'admin_id': admin_id,
+            'text': text,
+            'progress_msg_id': progress_msg_id,
+            'total': await self.storage.count('users'),
+            'processed': 0,
+            'success': 0,
+            'failed': 0,
+            'started': datetime.now(),
+            'done': False
+        }
+        await self.storage.put('broadcasts', broadcast_id, doc, durable=True)
+        self._spawn(broadcast_id, doc)
+        return True
+
+    async def resume_pending(self):
+        """Resume broadcasts interrupted by a restart"""
+        for broadcast_id, doc in await self.storage.find('broadcasts', done=False):
+            if not self.is_running(broadcast_id):
+                logger.info(f"Resuming broadcast {broadcast_id} at {doc['processed']}/{doc['total']}")
+                self._spawn(broadcast_id, doc)
+
+    def _spawn(self, broadcast_id, doc):
+        task = asyncio.create_task(self._run(broadcast_id, doc))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id, doc):
+        reporter = asyncio.create_task(self._report_loop(doc))
+        try:
+            skip = doc['processed']
+            chunk = []
+            async for user_id in self.storage.ids('users'):
+                if skip:
+                    skip -= 1
+                    continue
+                chunk.append(user_id)
+                if len(chunk) >= self.chunk_size:
+                    await self._send_chunk(broadcast_id, doc, chunk)
+                    chunk = []
+            if chunk:
+                await self._send_chunk(broadcast_id, doc, chunk)
+            doc['done'] = True
+            await self.storage.put('broadcasts', broadcast_id, doc, durable=True)
+        except Exception as e:
+            logger.error("Broadcast %s stopped: %s", broadcast_id, e)
+        finally:
+            reporter.cancel()
+        if doc['done']:
+            await self._report(doc, final=True)
+
+    async def _send_chunk(self, broadcast_id, doc, chunk):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                if await self._send(user_id, doc['text']):
+                    doc['success'] += 1
+                    self.sent += 1
+                else:
+                    doc['failed'] += 1
+                    self.failed += 1
+
+        await asyncio.gather(*[send(user_id) for user_id in chunk if user_id != doc['admin_id']])
+        doc['processed'] += len(chunk)
+        await self.storage.put('broadcasts', broadcast_id, doc)
+
+    async def _send(self, user_id, text):
+        # Broadcast's own share of the outbox rate; FloodWaits are
+        # retried by the outbox
+        await self.limiter.acquire()
+        try:
+            await self.outbox.send_message(user_id, text, priority=BROADCAST, parse_mode='md')
+            return True
+        except Exception as e:
+            logger.error("Failed to send broadcast to %s: %s", user_id, e, extra={'user_id': user_id})
+            return False
+
+    async def _report_loop(self, doc):
+        reported = None
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            current = (doc['success'], doc['failed'])
+            if current != reported:
+                reported = current
+                await self._report(doc, final=False)
+
+    async def _report(self, doc, final):
+        try:
+            await self.on_progress(doc, final)
+        except Exception as e:
+            logger.debug("Broadcast progress update failed: %s", e)
@@ -0,0 +1,112 @@
+import asyncio
+import csv
+import itertools
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('server', 'access_key', 'expiry')
+
+
+class CsvKeyWriter:
+    """Writes issued keys as CSV rows, one at a time"""
+
+    extension = 'csv'
+
+    def __init__(self, fh):
+        self._writer = csv.writer(fh)
+        self._writer.writerow(FIELDS)
+
+    def write(self, key):
+        self._writer.writerow([key['server'], key['access_key'], key['expiry'].isoformat()])
+
+    def close(self):
+        pass
+
+
+class JsonKeyWriter:
+    """Writes issued keys as a JSON array, one element at a time"""
+
+    extension = 'json'
+
+    def __init__(self, fh):
+        self._fh = fh
+        self._first = True
+        fh.write('[')
+
+    def write(self, key):
+        self._fh.write('\n  ' if self._first else ',\n  ')
+        self._first = False
+        json.dump({'server': key['server'], 'access_key': key['access_key'],
+                   'expiry': key['expiry'].isoformat()}, self._fh, ensure_ascii=False)
+
+    def close(self):
+        self._fh.write('\n]\n')
+
+
+WRITERS = {'csv': CsvKeyWriter, 'json': JsonKeyWriter}
+
+
+class BulkKeyJob:
+    """Issues many keys with a bounded number of Outline calls in flight.
+
+    Regions are used round-robin. Each key is handed to the writer as
+    soon as it is issued, so the export grows on disk instead of in
+    memory. `on_progress(job, final)` is called every `progress_interval`
+    seconds and once at the end.
+    """
+
+    def __init__(self, issue, regions, count, days, writer, on_progress,
+                 concurrency=8, progress_interval=5):
+        self.issue = issue
+        self.regions = regions
+        self.count = count
+        self.days = days
+        self.writer = writer
+        self.on_progress = on_progress
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.created = 0
+        self.failed = 0
+
+    @property
+    def processed(self):
+        return self.created + self.failed
+
+    async def _worker(self, slots):
+        for region in slots:
+            try:
+                key = await self.issue(region, self.days)
+            except Exception as e:
+                logger.error("Bulk key on %s failed: %s", region, e)
+                key = None
+            if key:
+                self.writer.write(key)
+                self.created += 1
+            else:
+                self.failed += 1
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._report(final=False)
+
+    async def _report(self, final):
+        try:
+            await self.on_progress(self, final)
+        except Exception as e:
+            logger.debug("Bulk key progress update failed: %s", e)
+
+    async def run(self):
+        """Issue all keys, returns the number created"""
+        # Workers share one iterator of regions, so each slot is taken once
+        slots = itertools.islice(itertools.cycle(self.regions), self.count)
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await asyncio.gather(*[self._worker(slots) for _ in range(min(self.concurrency, self.count))])
+        finally:
+            reporter.cancel()
+            self.writer.close()
+        await self._report(final=True)
+        return self.created
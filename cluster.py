@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import base64
+import bisect
+import functools
+import hashlib
+import hmac
+import itertools
+import logging
+import multiprocessing
+import os
+import secrets
+from collections import Counter, deque
+from datetime import datetime
+
+from telethon import TelegramClient, events, types, utils
+from telethon.extensions import BinaryReader
+
+from logs import setup_logging
+from settings import load_settings
+from storage import encode, decode
+
+logger = logging.getLogger(__name__)
+
+# Node id of the process that owns Outline, stats, payments and broadcasts.
+# Shard workers are identified by their shard number.
+SERVICES = 'services'
+
+
+class ClusterError(Exception):
+    """A call failed in another process"""
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring over shard numbers.
+
+    Every shard owns `replicas` points on the ring and a key belongs to
+    the shard of the first point after the key's hash, so changing the
+    number of shards moves only about 1/N of the users.
+    """
+
+    def __init__(self, shards, replicas=64):
+        points = sorted((_hash(f"{shard}:{i}"), shard) for shard in shards for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+async def write_frame(writer, message):
+    data = encode(message).encode('utf-8')
+    writer.write(len(data).to_bytes(4, 'big') + data)
+    await writer.drain()
+
+
+async def read_frame(reader):
+    size = int.from_bytes(await reader.readexactly(4), 'big')
+    return decode((await reader.readexactly(size)).decode('utf-8'))
+
+
+def update_sender(update):
+    """User id an update belongs to, 0 if it has none"""
+    user_id = getattr(update, 'user_id', None)
+    if user_id is not None:
+        return user_id
+    message = getattr(update, 'message', None)
+    peer = getattr(message, 'from_id', None) or getattr(message, 'peer_id', None)
+    return utils.get_peer_id(peer) if peer is not None else 0
+
+
+def pack_update(update):
+    entities = getattr(update, '_entities', None) or {}
+    return {
+        'type': 'update',
+        'update': base64.b64encode(bytes(update)).decode(),
+        'entities': [base64.b64encode(bytes(entity)).decode() for entity in entities.values()]
+    }
+
+
+async def dispatch_update(client, message):
+    """Run the client's event handlers for an update packed by the ingress"""
+    update = BinaryReader(base64.b64decode(message['update'])).tgread_object()
+    entities = [BinaryReader(base64.b64decode(data)).tgread_object() for data in message['entities']]
+    users = [entity for entity in entities if isinstance(entity, types.User)]
+    chats = [entity for entity in entities if not isinstance(entity, types.User)]
+    # Access hashes let this process reply to users it has never seen
+    client._mb_entity_cache.extend(users, chats)
+    update._entities = {utils.get_peer_id(entity): entity for entity in entities}
+    await client._dispatch_update(update)
+
+
+class ClusterNode:
+    """This process's place in a sharded deployment.
+
+    With `role='single'` the whole bot runs in one process and every call
+    is local. Otherwise shard workers handle the updates of the users they
+    own and the services process runs Outline, stats, payments and
+    broadcasts; functions registered with `on_shard` / `on_services` are
+    relayed through the ingress to the process that owns their state.
+    """
+
+    def __init__(self, role='single', shard=0, shards=1, address=None, secret='',
+                 offline=False, call_timeout=60):
+        self.role = role
+        self.shard = shard
+        self.shards = shards
+        self.ring = HashRing(range(shards))
+        self.address = address
+        self.secret = secret
+        self.offline = offline
+        self.call_timeout = call_timeout
+        self._handlers = {}
+        self._calls = {}
+        self._ids = itertools.count()
+        self._tasks = set()
+        self._writer = None
+
+    @classmethod
+    def from_env(cls):
+        """Node settings passed by cluster.py to its child processes"""
+        address = os.environ.get('VPN_BOT_INGRESS')
+        if address:
+            host, _, port = address.rpartition(':')
+            address = (host, int(port))
+        return cls(
+            role=os.environ.get('VPN_BOT_ROLE', 'single'),
+            shard=int(os.environ.get('VPN_BOT_SHARD', 0)),
+            shards=int(os.environ.get('VPN_BOT_SHARDS', 1)),
+            address=address,
+            secret=os.environ.get('VPN_BOT_SECRET', ''),
+            offline=os.environ.get('VPN_BOT_OFFLINE') == '1'
+        )
+
+    @property
+    def sharded(self):
+        return self.role != 'single'
+
+    @property
+    def runs_services(self):
+        return self.role in ('single', SERVICES)
+
+    @property
+    def node_id(self):
+        return SERVICES if self.role == SERVICES else self.shard
+
+    @property
+    def session(self):
+        """Telegram session file, one per process"""
+        if not self.sharded:
+            return 'vpn_bot'
+        return f"vpn_bot_{SERVICES if self.role == SERVICES else f'shard{self.shard}'}"
+
+    def owner(self, user_id):
+        return self.ring.shard_for(user_id)
+
+    def owns(self, user_id):
+        """Whether this process keeps state of the user"""
+        return self.role != 'worker' or self.owner(user_id) == self.shard
+
+    def is_local(self, target):
+        return not self.sharded or target == self.node_id
+
+    def on_services(self, func):
+        """Run the decorated coroutine function in the services process"""
+        self._handlers[func.__name__] = func
+
+        @functools.wraps(func)
+        async def call(*args):
+            return await self.call(SERVICES, func.__name__, *args)
+        return call
+
+    def on_shard(self, func):
+        """Run the decorated coroutine function in the shard of its first argument (a user id)"""
+        self._handlers[func.__name__] = func
+
+        @functools.wraps(func)
+        async def call(user_id, *args):
+            return await self.call(self.owner(user_id), func.__name__, user_id, *args)
+        return call
+
+    async def call(self, target, name, *args):
+        if self.is_local(target):
+            return await self._handlers[name](*args)
+
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        try:
+            await write_frame(self._writer, {
+                'type': 'call',
+                'id': call_id,
+                'target': target,
+                'reply_to': self.node_id,
+                'name': name,
+                'args': list(args)
+            })
+            return await asyncio.wait_for(future, self.call_timeout)
+        finally:
+            self._calls.pop(call_id, None)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def serve(self, on_update=None):
+        """Connect to the ingress and handle updates and calls until it closes"""
+        reader, self._writer = await asyncio.open_connection(*self.address)
+        await write_frame(self._writer, {'type': 'hello', 'node': self.node_id, 'secret': self.secret})
+        logger.info(f"Node {self.node_id} connected to ingress {self.address[0]}:{self.address[1]}")
+
+        while True:
+            try:
+                message = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            kind = message['type']
+            if kind == 'update' and on_update is not None:
+                self._spawn(on_update(message))
+            elif kind == 'call':
+                self._spawn(self._run_call(message))
+            elif kind == 'result':
+                future = self._calls.get(message['id'])
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(ClusterError(message['error']))
+                else:
+                    future.set_result(message['value'])
+        logger.warning(f"Node {self.node_id} lost connection to ingress")
+
+    async def _run_call(self, message):
+        reply = {'type': 'result', 'id': message['id'], 'target': message['reply_to']}
+        try:
+            reply['value'] = await self._handlers[message['name']](*message['args'])
+        except Exception as e:
+            logger.exception(f"Call {message['name']} failed")
+            reply['error'] = f"{type(e).__name__}: {e}"
+        await write_frame(self._writer, reply)
+
+
+class Ingress:
+    """Receives updates and relays frames between bot processes.
+
+    Updates are routed to shard workers by consistent hashing of the
+    sender id, so one user's updates are always handled by the same
+    process. Calls and results are relayed by their target node. Frames
+    for a node that is not connected yet (or restarting) are buffered.
+    """
+
+    def __init__(self, shards, host='127.0.0.1', port=0, secret='', backlog=10000):
+        self.ring = HashRing(range(shards))
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.routed = Counter()
+        self._writers = {}
+        self._backlog = {}
+        self._backlog_size = backlog
+        self._connected = {}
+        self._handlers = set()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Ingress listening on {self.host}:{self.port}")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers.values()):
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def _event(self, node):
+        if node not in self._connected:
+            self._connected[node] = asyncio.Event()
+        return self._connected[node]
+
+    async def wait_for(self, node):
+        await self._event(node).wait()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+        try:
+            hello = await read_frame(reader)
+        except (asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            return
+        if hello.get('type') != 'hello' or not hmac.compare_digest(hello.get('secret', ''), self.secret):
+            logger.warning("Rejected ingress connection with a bad secret")
+            writer.close()
+            return
+
+        node = hello['node']
+        self._writers[node] = writer
+        self._event(node).set()
+        backlog = self._backlog.pop(node, ())
+        for message in backlog:
+            await write_frame(writer, message)
+        logger.info(f"Node {node} connected, {len(backlog)} buffered frames sent")
+
+        try:
+            while True:
+                message = await read_frame(reader)
+                await self.send(message['target'], message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if self._writers.get(node) is writer:
+                del self._writers[node]
+                self._event(node).clear()
+            logger.warning(f"Node {node} disconnected")
+
+    async def send(self, node, message):
+        writer = self._writers.get(node)
+        if writer is not None:
+            try:
+                await write_frame(writer, message)
+                return
+            except ConnectionError:
+                pass
+        backlog = self._backlog.setdefault(node, deque(maxlen=self._backlog_size))
+        if len(backlog) == backlog.maxlen:
+            logger.warning(f"Backlog of node {node} is full, dropping oldest frame")
+        backlog.append(message)
+
+    async def route_update(self, update):
+        shard = self.ring.shard_for(update_sender(update))
+        self.routed[shard] += 1
+        await self.send(shard, pack_update(update))
+
+
+class StubUpdateSource:
+    """Synthetic updates for running the cluster without Telegram.
+
+    Each user sends /start first and then presses menu buttons.
+    """
+
+    BUTTONS = [b'my_keys', b'referral', b'buy_vpn', b'info', b'main_menu']
+
+    def __init__(self, count=1000, users=100, rate=500):
+        self.count = count
+        self.users = users
+        self.rate = rate
+        self._started = set()
+
+    def make(self, n):
+        user_id = 1000000 + n % self.users
+        user = types.User(id=user_id, access_hash=user_id * 7919, first_name=f"user{user_id}")
+        peer = types.PeerUser(user_id)
+        if user_id not in self._started:
+            self._started.add(user_id)
+            update = types.UpdateNewMessage(
+                message=types.Message(id=n + 1, peer_id=peer, date=datetime.now(), message='/start', from_id=peer),
+                pts=n + 1,
+                pts_count=1
+            )
+        else:
+            update = types.UpdateBotCallbackQuery(
+                query_id=n + 1,
+                user_id=user_id,
+                peer=peer,
+                msg_id=1,
+                chat_instance=user_id,
+                data=self.BUTTONS[n % len(self.BUTTONS)]
+            )
+        update._entities = {user_id: user}
+        return update
+
+    async def run(self, handle):
+        for n in range(self.count):
+            await handle(self.make(n))
+            await asyncio.sleep(1 / self.rate)
+
+
+def run_node(config, role, shard, shards, port, secret, offline):
+    """Entry point of a child process: import the bot and run it as a node"""
+    os.environ.update({
+        'VPN_BOT_ROLE': role,
+        'VPN_BOT_SHARD': str(shard),
+        'VPN_BOT_SHARDS': str(shards),
+        'VPN_BOT_INGRESS': f"127.0.0.1:{port}",
+        'VPN_BOT_SECRET': secret,
+        'VPN_BOT_OFFLINE': '1' if offline else '0'
+    })
+    settings = load_settings(config)
+    setup_logging(settings.log_level, settings.log_format)
+    if offline:
+        # Offline workers cannot reply, failed sends are expected
+        logging.getLogger('telethon').setLevel(logging.CRITICAL)
+    import bot
+    asyncio.run(bot.main(settings))
+
+
+async def supervise(processes, spawn, interval=5):
+    """Restart child processes that exited"""
+    while True:
+        await asyncio.sleep(interval)
+        for node, process in list(processes.items()):
+            if not process.is_alive():
+                logger.warning(f"Node {node} exited with code {process.exitcode}, restarting")
+                processes[node] = spawn(node)
+
+
+async def run_cluster(settings, workers, stub=0, port=0, config='config.ini'):
+    """Run ingress, services process and shard workers.
+
+    Child processes load their settings from the `config` file again.
+    """
+    if settings.storage_backend == 'journal':
+        raise ValueError("Storage backend 'journal' can't be shared by cluster processes")
+    ingress = Ingress(workers, port=port, secret=secrets.token_hex(16))
+    await ingress.start()
+    context = multiprocessing.get_context('spawn')
+
+    def spawn(node):
+        role, shard = (SERVICES, 0) if node == SERVICES else ('worker', node)
+        process = context.Process(
+            target=run_node,
+            args=(config, role, shard, workers, ingress.port, ingress.secret, bool(stub)),
+            daemon=True
+        )
+        process.start()
+        return process
+
+    # Services start first: they open and migrate the database
+    processes = {SERVICES: spawn(SERVICES)}
+    await ingress.wait_for(SERVICES)
+    for shard in range(workers):
+        processes[shard] = spawn(shard)
+    supervisor = asyncio.create_task(supervise(processes, spawn))
+
+    try:
+        if stub:
+            await StubUpdateSource(count=stub).run(ingress.route_update)
+            await asyncio.gather(*[ingress.wait_for(shard) for shard in range(workers)])
+            await asyncio.sleep(2)
+            logger.info(f"Stub updates routed per shard: {dict(sorted(ingress.routed.items()))}")
+        else:
+            client = TelegramClient('vpn_bot', settings.api_id, settings.api_hash)
+            client.add_event_handler(ingress.route_update, events.Raw)
+            await client.start(bot_token=settings.bot_token)
+            await client.run_until_disconnected()
+    finally:
+        supervisor.cancel()
+        await ingress.close()
+        for process in processes.values():
+            process.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot as an ingress with sharded workers')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--port', type=int, default=0, help='ingress port for worker connections')
+    parser.add_argument('--stub', type=int, default=0, metavar='N',
+                        help='feed N synthetic updates instead of connecting to Telegram')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+    settings = load_settings(args.config)
+    setup_logging(settings.log_level, settings.log_format)
+    asyncio.run(run_cluster(settings, args.workers, args.stub, args.port, args.config))
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, allows one trial call after cooldown"""
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def can_try(self):
+        """Whether a call may be made now, without taking the trial"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # Half-open: a single trial call, another one only if its outcome
+        # is never recorded
+        return self.trial_at is None or now - self.trial_at >= self.reset_timeout
+
+    def acquire_trial(self):
+        """Like can_try, but takes the half-open trial for the caller"""
+        if not self.can_try():
+            return False
+        if self.opened_at is not None:
+            self.trial_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.trial_at = None
+
+
+class ServerHealth:
+    """Latency and error rate of one Outline server"""
+
+    def __init__(self, breaker, alpha=0.2):
+        self.breaker = breaker
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+
+    def observe(self, ok, latency):
+        if ok and self.latency is None:
+            self.latency = latency
+        elif ok:
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+
+class HealthMonitor:
+    """Probes Outline servers and picks the best server for a region.
+
+    Real API calls and periodic probes both feed per-server latency and
+    error-rate averages and a circuit breaker. Key creation picks the
+    server with the lowest latency weighted by in-flight load and error
+    rate, and skips servers whose breaker is open.
+    """
+
+    def __init__(self, transport, regions, interval=30, failure_threshold=3, reset_timeout=30):
+        self.transport = transport
+        self.regions = regions
+        self.interval = interval
+        self.servers = {
+            server: ServerHealth(CircuitBreaker(failure_threshold, reset_timeout))
+            for servers in regions.values()
+            for server in servers
+        }
+        transport.listeners.append(self.observe)
+
+    def observe(self, server, ok, latency):
+        health = self.servers.get(server)
+        if health is not None:
+            health.observe(ok, latency)
+
+    def is_available(self, server):
+        health = self.servers.get(server)
+        return health is not None and health.breaker.can_try()
+
+    def acquire(self, server):
+        """Check a server right before calling it, taking its trial call"""
+        health = self.servers.get(server)
+        return health is not None and health.breaker.acquire_trial()
+
+    def ranked(self, region):
+        """Available servers of a region, best first"""
+        scored = []
+        for server in self.regions.get(region, ()):
+            health = self.servers[server]
+            if not health.breaker.can_try():
+                continue
+            load = 1 + self.transport.in_flight(server) / self.transport.max_in_flight
+            # A failed call costs about one read timeout
+            score = (health.latency or 0) * load + health.error_rate * self.transport.read_timeout
+            scored.append((score, server))
+        scored.sort()
+        return [server for _, server in scored]
+
+    async def probe(self, server):
+        """Ping server API, outcome is recorded through the transport"""
+        try:
+            await self.transport.post(server, {'method': 'get_server_info'})
+        except Exception as e:
+            logger.warning("Outline probe failed for %s: %s", server, e, extra={'server': server})
+
+    async def run(self):
+        """Probe all servers periodically"""
+        while True:
+            await asyncio.gather(*[self.probe(server) for server in self.servers])
+            down = [server for server, health in self.servers.items() if health.breaker.is_open]
+            if down:
+                logger.warning("Outline servers down: %s", ', '.join(down))
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        """{server: (latency, error_rate, is_open)} for admin views"""
+        return {
+            server: (health.latency, health.error_rate, health.breaker.is_open)
+            for server, health in self.servers.items()
+        }
@@ -0,0 +1,84 @@
+import heapq
+
+
+class KeyIndex:
+    """In-memory index of active keys.
+
+    Keeps a user_id -> keys mapping for per-user lookups and an
+    expiry-ordered heap, so expired keys are dropped incrementally
+    instead of rescanning every key ever issued.
+    """
+
+    def __init__(self, on_expire=None):
+        # Called as listener([(key, entry)]) with keys dropped by advance()
+        self.listeners = [on_expire] if on_expire else []
+        self._keys = {}     # key -> (user_id, server, expiry)
+        self._by_user = {}  # user_id -> {key: expiry}
+        self._heap = []     # (expiry, key), stale entries skipped lazily
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key, user_id, server, expiry):
+        """Index a key, replacing a previous entry for the same key"""
+        self.discard(key)
+        self._keys[key] = (user_id, server, expiry)
+        self._by_user.setdefault(user_id, {})[key] = expiry
+        heapq.heappush(self._heap, (expiry, key))
+
+    def discard(self, key):
+        """Drop a key from the index, returns its entry or None"""
+        entry = self._keys.pop(key, None)
+        if entry is None:
+            return None
+        user_id = entry[0]
+        user_keys = self._by_user.get(user_id)
+        if user_keys is not None:
+            user_keys.pop(key, None)
+            if not user_keys:
+                del self._by_user[user_id]
+        return entry
+
+    def _is_live(self, expiry, key):
+        entry = self._keys.get(key)
+        return entry is not None and entry[2] == expiry
+
+    def next_expiry(self):
+        """Expiry of the earliest active key, or None"""
+        heap = self._heap
+        while heap and not self._is_live(*heap[0]):
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def advance(self, now):
+        """Drop keys that expired by `now`, returns [(key, entry)]"""
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expiry, key = heapq.heappop(heap)
+            if self._is_live(expiry, key):
+                expired.append((key, self.discard(key)))
+        if expired:
+            for listener in self.listeners:
+                listener(expired)
+        return expired
+
+    def active_count(self, now):
+        """Number of active keys, amortized O(log n)"""
+        self.advance(now)
+        return len(self._keys)
+
+    def user_key_count(self, user_id, now):
+        """Number of active keys of one user, amortized O(log n)"""
+        self.advance(now)
+        return len(self._by_user.get(user_id, ()))
+
+    def user_keys_page(self, user_id, now, offset, limit):
+        """Page of a user's active keys as [(key, server, expiry)] by expiry, without sorting them all"""
+        self.advance(now)
+        first = heapq.nsmallest(offset + limit, self._by_user.get(user_id, {}).items(),
+                                key=lambda item: item[1])
+        return [(key, self._keys[key][1], expiry) for key, expiry in first[offset:]]
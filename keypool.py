@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class KeyPool:
+    """Warm pool of pre-created Outline keys per server.
+
+    A purchase claims a pooled key instead of waiting for the Outline
+    create call. The key's name, limit and expiry are then set with one
+    update call in the background. A refill task tops each server up to
+    `high` keys whenever it drops below `low`.
+    """
+
+    def __init__(self, storage, create, update, servers, acquire,
+                 low=5, high=20, concurrency=2, retry_interval=60):
+        self.storage = storage
+        self.create = create
+        self.update = update
+        self.servers = servers
+        self.acquire = acquire
+        self.low = low
+        self.high = high
+        self.concurrency = concurrency
+        self.retry_interval = retry_interval
+        self._pools = {server: deque() for server in servers}
+        self._wake = asyncio.Event()
+        self._updates = set()
+
+    def size(self, server):
+        return len(self._pools.get(server, ()))
+
+    async def load(self):
+        """Restore pooled keys saved before restart"""
+        async for _, doc in self.storage.scan('pool'):
+            pool = self._pools.get(doc['server'])
+            if pool is not None:
+                pool.append((doc['key_id'], doc['access_key']))
+        self._wake.set()
+
+    async def claim(self, servers, days):
+        """Take a pooled key from the first server that has one"""
+        for server in servers:
+            pool = self._pools.get(server)
+            if not pool:
+                continue
+            key_id, access_key = pool.popleft()
+            await self.storage.delete('pool', f"{server}:{key_id}")
+            if len(pool) < self.low:
+                self._wake.set()
+
+            task = asyncio.create_task(self._assign(server, key_id, days))
+            self._updates.add(task)
+            task.add_done_callback(self._updates.discard)
+            return {
+                'key_id': key_id,
+                'access_key': access_key,
+                'server': server,
+                'expiry': datetime.now() + timedelta(days=days)
+            }
+        return None
+
+    async def _assign(self, server, key_id, days):
+        # Expiry is enforced locally by the reaper, so a failed update
+        # only leaves the pool name on the Outline side
+        if not await self.update(key_id, server, days):
+            logger.warning("Failed to update pooled key %s on %s", key_id, server, extra={'server': server})
+
+    async def run(self):
+        """Refill loop"""
+        while True:
+            self._wake.clear()
+            await asyncio.gather(*[self._refill(server) for server in self.servers])
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.retry_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill(self, server):
+        pool = self._pools[server]
+        if len(pool) >= self.low or not self.acquire(server):
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def create_one():
+            async with semaphore:
+                key = await self.create(server)
+            if key is None:
+                return False
+            pool.append((key['key_id'], key['access_key']))
+            await self.storage.put('pool', f"{server}:{key['key_id']}", {
+                'server': server,
+                'key_id': key['key_id'],
+                'access_key': key['access_key'],
+                'created': datetime.now()
+            })
+            return True
+
+        missing = self.high - len(pool)
+        # The first key is created alone, it is the trial call if the
+        # server's breaker is half-open
+        created = int(await create_one())
+        if created:
+            created += sum(await asyncio.gather(*[create_one() for _ in range(missing - 1)]))
+        logger.info("Key pool %s: created %d/%d, size %d", server, created, missing, len(pool))
@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from aiohttp import web
+from telethon import events
+from telethon.errors import FloodWaitError
+
+import bot
+from logs import setup_logging
+from payments import WebhookProvider
+from settings import OutlineSettings, PaymentSettings, Settings
+
+logger = logging.getLogger(__name__)
+
+ADMIN_ID = 1
+FIRST_USER_ID = 100000
+
+# Buttons pressed by simulated users after /start
+USER_CALLBACKS = [
+    b'main_menu', b'buy_vpn', b'server_EU', b'duration_EU_30', b'my_keys',
+    b'referral', b'info', b'support', b'pay_balance_EU_7', b'payment_US_7',
+]
+
+
+class FakeMessage:
+    def __init__(self, message_id, chat_id, text):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.text = text
+        self.message = text
+        self.out = False
+
+
+class FakeEvent:
+    """Incoming message or button press, with the event API the handlers use"""
+
+    def __init__(self, client, sender_id, text=None, data=None, message_id=1):
+        self.client = client
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.data = data
+        self.message_id = message_id
+        self.pattern_match = None
+        self.message = None
+        if text is not None:
+            self.message = client.receive(sender_id, text)
+            self.text = self.raw_text = text
+
+    async def respond(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, **kwargs)
+
+    async def edit(self, text, **kwargs):
+        return await self.client.edit_message(self.chat_id, self.message_id, text, **kwargs)
+
+    async def answer(self, message=None, **kwargs):
+        await self.client.request()
+        self.client.answers += 1
+
+    async def delete(self):
+        await self.client.request()
+
+    async def forward_to(self, chat_id):
+        return await self.client.send_message(chat_id, self.message.text)
+
+
+class FakeTelegram:
+    """Offline stand-in for TelegramClient.
+
+    Dispatches fake events to the registered handlers with the same
+    pattern and func filters Telethon applies, counts outgoing calls and
+    answers a share of them (`flood_rate`) with a FloodWait.
+    """
+
+    def __init__(self, latency=0.0, flood_rate=0.0, flood_seconds=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.handlers = []
+        self.sent = 0
+        self.edits = 0
+        self.answers = 0
+        self.flood_waits = 0
+        self.running = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._messages = {}
+        self._ids = itertools.count(1)
+
+    def add_event_handler(self, callback, builder):
+        self.handlers.append((callback, builder))
+
+    async def start(self, **kwargs):
+        return self
+
+    async def run_until_disconnected(self):
+        self.running.set()
+        await self._disconnected.wait()
+
+    def disconnect(self):
+        self._disconnected.set()
+
+    async def request(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(None, capture=self.flood_seconds)
+
+    def receive(self, chat_id, text):
+        message = FakeMessage(next(self._ids), chat_id, text)
+        self._messages[chat_id, message.id] = message
+        return message
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.request()
+        self.sent += 1
+        return FakeMessage(next(self._ids), chat_id, text)
+
+    async def send_file(self, chat_id, file, **kwargs):
+        await self.request()
+        self.sent += 1
+        return FakeMessage(next(self._ids), chat_id, kwargs.get('caption'))
+
+    async def edit_message(self, chat_id, message_id, text=None, **kwargs):
+        await self.request()
+        self.edits += 1
+
+    async def get_messages(self, chat_id, ids=None):
+        return self._messages.get((chat_id, ids))
+
+    @staticmethod
+    def _matches(builder, event):
+        if isinstance(builder, events.CallbackQuery):
+            value = event.data
+            pattern = builder.match
+        elif isinstance(builder, events.NewMessage):
+            value = event.message.message if event.message else None
+            pattern = builder.pattern
+        else:
+            return False
+        if value is None:
+            return False
+        if pattern:
+            event.pattern_match = pattern(value)
+            if not event.pattern_match:
+                return False
+        return not builder.func or builder.func(event)
+
+    async def dispatch(self, event):
+        for callback, builder in self.handlers:
+            if self._matches(builder, event):
+                await callback(event)
+
+
+class AutoConfirmProvider(WebhookProvider):
+    """Payment provider whose poll confirms an invoice with probability `auto_confirm`"""
+
+    def __init__(self, auto_confirm=0.8):
+        super().__init__()
+        self.auto_confirm = auto_confirm
+        self.paid = set()
+
+    async def check(self, payment_ids):
+        for payment_id in payment_ids:
+            if random.random() < self.auto_confirm:
+                self.paid.add(payment_id)
+        return {payment_id for payment_id in payment_ids if payment_id in self.paid}
+
+
+class FakeOutline:
+    """Local Outline API stub with configurable latency and error rate"""
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.url = None
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.transferred = {}   # key_id -> bytes, grows on every metrics call
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/api', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(self._runner, sock).start()
+        self.port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}/api"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request):
+        payload = await request.json()
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({'error': 'injected failure'}, status=500)
+        method = payload.get('method')
+        if method == 'create_key':
+            key_id = next(self._ids)
+            self.transferred[str(key_id)] = 0
+            return web.json_response({'result': {'id': key_id, 'access_key': f"ss://loadtest{key_id}@127.0.0.1:{self.port}"}})
+        if method == 'delete_key':
+            self.transferred.pop(str(payload['params']['id']), None)
+        elif method == 'get_transfer_metrics':
+            for key_id in self.transferred:
+                self.transferred[key_id] += random.randint(0, 50 * 1024 * 1024)
+            return web.json_response({'result': {'bytesTransferredByUserId': self.transferred}})
+        return web.json_response({'result': True})
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    """Record how late the loop wakes up from a short sleep"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+
+class LoadTest:
+    """Drives the real bot handlers with simulated users"""
+
+    def __init__(self, client, users=1000, actions=10, concurrency=100):
+        self.client = client
+        self.users = users
+        self.actions = actions
+        self.concurrency = concurrency
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.events = 0
+
+    @staticmethod
+    def route_name(event):
+        if event.data is None:
+            text = event.message.text
+            return text.split()[0] if text.startswith('/') else 'message'
+        resolved = bot.router.resolve(event.data)
+        return resolved[0].__name__ if resolved else 'unknown'
+
+    async def send(self, event):
+        name = self.route_name(event)
+        started = time.perf_counter()
+        try:
+            await self.client.dispatch(event)
+        except Exception as e:
+            self.errors[name] += 1
+            logger.debug(f"{name} failed: {e}")
+        self.latencies[name].append(time.perf_counter() - started)
+        self.events += 1
+
+    async def user_session(self, user_id, semaphore):
+        async with semaphore:
+            await self.send(FakeEvent(self.client, user_id, text='/start'))
+            # Half of the users can pay from their balance
+            if user_id % 2:
+                user = await bot.storage.get('users', user_id)
+                user['balance'] += 1000
+            for _ in range(self.actions):
+                await self.send(FakeEvent(self.client, user_id, data=random.choice(USER_CALLBACKS)))
+
+    async def run_users(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[
+            self.user_session(FIRST_USER_ID + n, semaphore) for n in range(self.users)
+        ])
+
+    async def run_broadcast(self, timeout=600):
+        """Admin drafts and confirms a broadcast, returns its duration"""
+        await self.send(FakeEvent(self.client, ADMIN_ID, text='/start'))
+        await self.send(FakeEvent(self.client, ADMIN_ID, data=b'admin_broadcast'))
+        draft = FakeEvent(self.client, ADMIN_ID, text='Load test broadcast')
+        await self.send(draft)
+        started = time.monotonic()
+        await self.send(FakeEvent(self.client, ADMIN_ID, data=f"confirm_broadcast_{draft.message.id}".encode()))
+
+        broadcast_id = f"{ADMIN_ID}_{draft.message.id}"
+        while time.monotonic() - started < timeout:
+            doc = await bot.storage.get('broadcasts', broadcast_id)
+            if doc and doc['done']:
+                break
+            await asyncio.sleep(0.05)
+        return time.monotonic() - started
+
+
+async def run(args):
+    outlines = {region: FakeOutline(args.outline_latency, args.outline_jitter, args.outline_error_rate)
+                for region in ('EU', 'US', 'ASIA')}
+    for outline in outlines.values():
+        await outline.start()
+
+    tmp = tempfile.TemporaryDirectory()
+    settings = Settings(
+        api_id=1,
+        api_hash='loadtest',
+        bot_token='1:loadtest',
+        admin_ids=[ADMIN_ID],
+        outline=OutlineSettings(
+            servers={region: {'api_url': outline.url, 'cert': None} for region, outline in outlines.items()},
+            regions={region: [region] for region in outlines},
+            pool_low=args.pool_low,
+            pool_high=args.pool_high
+        ),
+        payments=PaymentSettings(webhook_port=0),
+        storage_backend=args.backend,
+        storage_path=os.path.join(tmp.name, 'loadtest.db'),
+        send_rate=args.send_rate,
+        broadcast_rate=args.broadcast_rate,
+        broadcast_concurrency=args.broadcast_concurrency,
+        metrics_port=args.metrics_port
+    )
+    client = FakeTelegram(latency=args.telegram_latency, flood_rate=args.flood_rate)
+    bot.create_app(settings, client, AutoConfirmProvider())
+
+    if args.memory:
+        tracemalloc.start()
+    app = asyncio.create_task(bot.main())
+    await client.running.wait()
+    memory_before = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    test = LoadTest(client, users=args.users, actions=args.actions, concurrency=args.concurrency)
+    started = time.monotonic()
+    await test.run_users()
+    elapsed = time.monotonic() - started
+    broadcast_time = await test.run_broadcast() if args.broadcast else None
+    lag_task.cancel()
+    memory_after = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    client.disconnect()
+    await app
+    for outline in outlines.values():
+        await outline.close()
+    tmp.cleanup()
+
+    print(f"{'route':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(test.latencies.items()):
+        print(f"{name:<28}{len(values):>8}{test.errors[name]:>8}"
+              f"{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}")
+    print()
+    print(f"Users: {args.users}, events: {test.events}, {test.events / elapsed:.0f} events/s over {elapsed:.1f}s")
+    print(f"Loop lag: p50 {percentile(lag, 0.5) * 1000:.2f} ms, p99 {percentile(lag, 0.99) * 1000:.2f} ms, "
+          f"max {max(lag, default=0) * 1000:.2f} ms")
+    if args.memory:
+        print(f"Memory growth: {(memory_after - memory_before) / 1024:.0f} KiB "
+              f"({(memory_after - memory_before) / max(1, args.users):.0f} B per user)")
+    print(f"Telegram: {client.sent} sends, {client.edits} edits, {client.answers} answers, "
+          f"{client.flood_waits} FloodWaits")
+    print(f"Outline: {sum(o.requests for o in outlines.values())} requests, "
+          f"{sum(o.errors for o in outlines.values())} injected errors")
+    if broadcast_time is not None:
+        print(f"Broadcast to {args.users} users: {broadcast_time:.1f}s "
+              f"({args.users / max(broadcast_time, 1e-9):.0f} msg/s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline load test of the bot handlers')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--actions', type=int, default=10, help='button presses per user after /start')
+    parser.add_argument('--concurrency', type=int, default=100, help='users active at the same time')
+    parser.add_argument('--backend', default='memory', choices=['memory', 'sqlite', 'journal'])
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of Telegram calls answered with FloodWait')
+    parser.add_argument('--outline-latency', type=float, default=0.05)
+    parser.add_argument('--outline-jitter', type=float, default=0.02)
+    parser.add_argument('--outline-error-rate', type=float, default=0.0)
+    parser.add_argument('--pool-low', type=int, default=5)
+    parser.add_argument('--pool-high', type=int, default=20)
+    parser.add_argument('--send-rate', type=float, default=1000, help='outgoing messages per second')
+    parser.add_argument('--broadcast-rate', type=float, default=1000)
+    parser.add_argument('--broadcast-concurrency', type=int, default=50)
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve /metrics during the run')
+    parser.add_argument('--no-broadcast', dest='broadcast', action='store_false')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc, it slows handlers')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    setup_logging(logging.INFO if args.verbose else logging.ERROR, fmt='text')
+    asyncio.run(run(args))
@@ -0,0 +1,80 @@
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+
+
+class LockRegistry:
+    """Per-key asyncio locks, created on demand.
+
+    Locks are held in a WeakValueDictionary, so a lock disappears as soon
+    as no coroutine holds or waits on it and the registry only grows with
+    the number of users currently doing something.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def __getitem__(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class SingleFlight:
+    """Runs one operation per idempotency key.
+
+    Calls with a key that is in flight await the same task instead of
+    starting a new one. Keys of finished operations are remembered for
+    `ttl` seconds (at most `maxsize` of them), so a late duplicate returns
+    the stored result; with `ttl=0` calls are joined only while in flight.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._in_flight = {}
+        self._done = OrderedDict()   # key -> (finished_at, result)
+
+    def __contains__(self, key):
+        return key in self._in_flight or self._recent(key) is not None
+
+    def _recent(self, key):
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._done[key]
+            return None
+        return entry
+
+    async def run(self, key, func):
+        """Result of func() for key, started at most once"""
+        entry = self._recent(key)
+        if entry is not None:
+            return entry[1]
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._finish(key, task))
+        # A cancelled caller must not cancel the shared operation
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        del self._in_flight[key]
+        if not self.ttl or task.cancelled() or task.exception() is not None:
+            return
+        self._done[key] = (time.monotonic(), task.result())
+        self._done.move_to_end(key)
+        now = time.monotonic()
+        while self._done:
+            oldest_key, (finished_at, _) = next(iter(self._done.items()))
+            if len(self._done) <= self.maxsize and now - finished_at <= self.ttl:
+                break
+            del self._done[oldest_key]
@@ -0,0 +1,146 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+# Structured fields copied from the record into the JSON line
+FIELDS = ('user_id', 'route', 'server')
+
+# Set per handler call by `contextual`, added to every record it logs
+log_context = contextvars.ContextVar('log_context', default={})
+
+
+def contextual(route, func):
+    """Wrap an async handler so its records carry the route and user_id"""
+    @functools.wraps(func)
+    async def wrapper(event, *args, **kwargs):
+        token = log_context.set({'route': route, 'user_id': getattr(event, 'sender_id', None)})
+        try:
+            return await func(event, *args, **kwargs)
+        finally:
+            log_context.reset(token)
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    """Copy the handler context into records that don't set the fields"""
+
+    def filter(self, record):
+        for name, value in log_context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop repeats of the same warning or error.
+
+    Records are grouped by call site, so one failing line (a broadcast
+    recipient, an unreachable Outline server) logs at most `burst` records
+    per `interval` seconds. The first record after a quiet window carries
+    the number of records dropped before it in `suppressed`.
+    """
+
+    def __init__(self, interval=60, burst=5, level=logging.WARNING, maxsize=1024):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self.maxsize = maxsize
+        self._windows = {}   # call site -> [window_start, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] > self.interval:
+            if len(self._windows) >= self.maxsize:
+                self._windows.clear()
+            suppressed = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        window[1] += 1
+        if window[1] > self.burst:
+            window[2] += 1
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in FIELDS + ('suppressed',):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The usual text format with structured fields appended"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = ' '.join(f"{name}={getattr(record, name)}" for name in FIELDS + ('suppressed',)
+                         if getattr(record, name, None) is not None)
+        return f"{line} [{extra}]" if extra else line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike the stock prepare(), msg % args is left to the writer
+        # thread, so records logged with %-style arguments are formatted
+        # there. exc_info is rendered here, while the traceback still exists
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(level=logging.INFO, fmt='json', stream=None, interval=60, burst=5):
+    """Route all logging through a queue drained by a writer thread.
+
+    The calling thread (the event loop) only filters and enqueues records;
+    formatting and writing to `stream` happen in the listener thread. Only
+    %-style arguments are formatted lazily, f-strings are built by the caller.
+    Returns the listener, which is also stopped at exit.
+    """
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    handler = _QueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(interval, burst))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
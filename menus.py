@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+from telethon import TelegramClient
+
+
+class MenuRegistry:
+    """Pre-built message templates and reply markups.
+
+    A menu builder returns `(text, buttons)`. Static menus are built and
+    compiled to a reply markup once, when they are registered.
+    Parametrized menus (per server, per duration) are built on first use
+    and kept in a bounded LRU. Per-user values such as the balance are
+    left as `{name}` fields in the text and filled in by `render`.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._static = {}
+        self._builders = {}
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _compile(text, buttons):
+        return text, TelegramClient.build_reply_markup(buttons)
+
+    def static(self, name):
+        """Register a menu without parameters, built right away"""
+        def decorator(build):
+            self._static[name] = self._compile(*build())
+            return build
+        return decorator
+
+    def menu(self, name):
+        """Register a parametrized menu, built on first use"""
+        def decorator(build):
+            self._builders[name] = build
+            return build
+        return decorator
+
+    def get(self, name, *params):
+        """(text, markup) of a menu"""
+        menu = self._static.get(name)
+        if menu is not None:
+            return menu
+
+        key = (name, params)
+        menu = self._cache.get(key)
+        if menu is not None:
+            self._cache.move_to_end(key)
+            return menu
+        menu = self._cache[key] = self._compile(*self._builders[name](*params))
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return menu
+
+    def markup(self, name, *params):
+        """Reply markup of a menu"""
+        return self.get(name, *params)[1]
+
+    def render(self, name, *params, **fields):
+        """(text, markup) with per-request fields filled into the text"""
+        text, markup = self.get(name, *params)
+        return text.format(**fields), markup
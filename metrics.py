@@ -0,0 +1,192 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a dict lookup to a slow Outline call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    """Labelled values of one metric.
+
+    Values are kept in a dict keyed by the tuple of label values. A metric
+    built with `func` has no state of its own: `func()` is called on
+    scrape and returns a number, or a dict of label tuples to numbers.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self._values = {}
+
+    def values(self):
+        if self.func is None:
+            return self._values
+        values = self.func()
+        return values if isinstance(values, dict) else {(): values}
+
+    def samples(self):
+        for label_values, value in self.values().items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Bucketed distribution, cumulated only when scraped"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            # Per-bucket counts plus +Inf, then sum
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labels, label_values, [('le', bound)]), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), total
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), cumulative
+
+
+class Metrics:
+    """Process metrics in the Prometheus text format.
+
+    Recording is a dict update (plus a bisect for histograms), so it can
+    sit on every handler call. Gauges of other components are read
+    through callbacks on scrape. `start()` serves `/metrics` over HTTP
+    and samples event loop lag in the background.
+    """
+
+    def __init__(self, host='127.0.0.1', port=9100, lag_interval=0.5):
+        self.host = host
+        self.port = port
+        self.lag_interval = lag_interval
+        self._metrics = []
+        self._runner = None
+        self._lag_task = None
+
+        self.handler_latency = self.histogram(
+            'bot_handler_seconds', 'Telegram handler latency', ['route'])
+        self.handler_errors = self.counter(
+            'bot_handler_errors_total', 'Telegram handlers that raised', ['route'])
+        self.loop_lag = self.histogram(
+            'bot_event_loop_lag_seconds', 'Delay of the event loop waking up from a sleep')
+        self.outline_latency = self.histogram(
+            'bot_outline_request_seconds', 'Outline API request latency', ['server'])
+        self.outline_requests = self.counter(
+            'bot_outline_requests_total', 'Outline API requests by outcome', ['server', 'outcome'])
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), func=None):
+        return self._add(Counter(name, help, labels, func))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._add(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def instrument(self, route, func):
+        """Wrap an async handler to record its latency and errors"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                self.handler_errors.inc(route)
+                raise
+            finally:
+                self.handler_latency.observe(time.perf_counter() - started, route)
+        return wrapper
+
+    def observe_outline(self, server, ok, latency):
+        """OutlineTransport listener"""
+        self.outline_latency.observe(latency, server)
+        self.outline_requests.inc(server, 'ok' if ok else 'error')
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.error(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    async def _handle(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    async def _sample_lag(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            self.loop_lag.observe(max(0.0, time.monotonic() - started - self.lag_interval))
+
+    async def start(self):
+        """Start the lag sampler and the /metrics endpoint"""
+        self._lag_task = asyncio.create_task(self._sample_lag())
+        if self.port:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            logger.info(f"Metrics listening on {self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
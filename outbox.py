@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from telethon.errors import FloodWaitError
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower is sent first
+KEY_DELIVERY = 0
+NOTIFICATION = 1
+BROADCAST = 2
+
+
+class TokenBucket:
+    """Token bucket rate limiter shared by concurrent senders"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens, e.g. after a FloodWait"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class Outbox:
+    """Single queue for outgoing Telegram calls.
+
+    Calls wait in a FIFO per chat, so messages to one chat keep their
+    order. Chats with pending calls are picked by the most urgent
+    priority they hold, which lets a key delivery overtake a running
+    broadcast. All calls share one token bucket, and a chat gets at most
+    one call per `chat_interval` seconds; a FloodWait pauses the bucket
+    for everyone and the call is retried from the head of its chat queue.
+    """
+
+    def __init__(self, client, rate=25, workers=10, max_attempts=3, chat_interval=1):
+        self.client = client
+        self.limiter = TokenBucket(rate)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.chat_interval = chat_interval
+        self.flood_waits = 0
+        self.sent = 0
+        self._chats = {}     # chat_id -> deque of [priority, func, args, kwargs, future, attempts]
+        self._ready = []     # (priority, seq, chat_id), superseded entries skipped lazily
+        self._queued = {}    # chat_id -> (priority, seq) of its live _ready entry
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    def __len__(self):
+        return sum(len(calls) for calls in self._chats.values())
+
+    def _schedule(self, chat_id, priority=None):
+        if priority is None:
+            priority = min(call[0] for call in self._chats[chat_id])
+        seq = next(self._seq)
+        self._queued[chat_id] = (priority, seq)
+        heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._wake.set()
+
+    def _release(self, chat_id):
+        """Reschedule a chat after its call and cooldown, or forget it"""
+        calls = self._chats.get(chat_id)
+        if calls:
+            self._schedule(chat_id)
+        elif calls is not None:
+            del self._chats[chat_id]
+
+    def _drop_stale(self):
+        ready = self._ready
+        while ready and self._queued.get(ready[0][2], (None, None))[1] != ready[0][1]:
+            heapq.heappop(ready)
+
+    def _submit(self, chat_id, priority, func, *args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        calls = self._chats.get(chat_id)
+        if calls is None:
+            calls = self._chats[chat_id] = deque()
+            calls.append([priority, func, args, kwargs, future, 0])
+            self._schedule(chat_id)
+            return future
+        calls.append([priority, func, args, kwargs, future, 0])
+        # A waiting chat moves up to its most urgent call; one being sent
+        # to or cooling down picks it up when it is released
+        queued = self._queued.get(chat_id)
+        if queued is not None and priority < queued[0]:
+            self._schedule(chat_id, priority)
+        return future
+
+    def send_message(self, chat_id, text, priority=NOTIFICATION, **kwargs):
+        """Queue a message, the result resolves to the sent message"""
+        return self._submit(chat_id, priority, self.client.send_message, chat_id, text, **kwargs)
+
+    def edit_message(self, chat_id, message_id, text, priority=NOTIFICATION, **kwargs):
+        return self._submit(chat_id, priority, self.client.edit_message, chat_id, message_id, text, **kwargs)
+
+    def send_file(self, chat_id, file, priority=NOTIFICATION, **kwargs):
+        return self._submit(chat_id, priority, self.client.send_file, chat_id, file, **kwargs)
+
+    async def _call(self, chat_id, call):
+        """Run the call at the head of a chat queue, False to retry it"""
+        priority, func, args, kwargs, future, attempts = call
+        if future.cancelled():
+            return True
+        try:
+            result = await func(*args, **kwargs)
+        except FloodWaitError as e:
+            self.flood_waits += 1
+            logger.warning("FloodWait for %ss, outgoing messages paused", e.seconds, extra={'user_id': chat_id})
+            self.limiter.pause(e.seconds)
+            call[5] += 1
+            if call[5] < self.max_attempts:
+                return False
+            error = e
+        except Exception as e:
+            error = e
+        else:
+            self.sent += 1
+            if not future.done():
+                future.set_result(result)
+            return True
+        if not future.done():
+            future.set_exception(error)
+        return True
+
+    async def _worker(self):
+        while True:
+            self._drop_stale()
+            while not self._ready:
+                self._wake.clear()
+                await self._wake.wait()
+                self._drop_stale()
+            # Pick the chat only once a token is granted, so the most
+            # urgent call at that moment goes first
+            await self.limiter.acquire()
+            self._drop_stale()
+            if not self._ready:
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            del self._queued[chat_id]
+            calls = self._chats[chat_id]
+            if await self._call(chat_id, calls[0]):
+                calls.popleft()
+            if self.chat_interval:
+                # The chat stays known while it cools down, so calls queued
+                # meanwhile wait for the release instead of being scheduled
+                asyncio.get_running_loop().call_later(self.chat_interval, self._release, chat_id)
+            else:
+                self._release(chat_id)
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for calls in self._chats.values():
+            for call in calls:
+                call[4].cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._queued.clear()
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+import re
+import ssl
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Outline prints the management certificate as a SHA-256 fingerprint
+FINGERPRINT_RE = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+class OutlineTransport:
+    """Pooled async HTTP transport for Outline management APIs.
+
+    One keep-alive session is kept per server, so repeated calls reuse
+    TLS connections instead of opening a new one for every key.
+    """
+
+    def __init__(self, servers, connect_timeout=3, read_timeout=10,
+                 max_in_flight=8, pool_size=16):
+        self.servers = servers
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_in_flight = max_in_flight
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._limits = {}
+        self._in_flight = {}
+        # Called as listener(server, ok, latency) after every request
+        self.listeners = []
+
+    @staticmethod
+    def _ssl_for(cert):
+        """Build SSL settings honoring the per-server cert pinning"""
+        if not cert:
+            return None
+        if FINGERPRINT_RE.match(cert):
+            return aiohttp.Fingerprint(bytes.fromhex(cert))
+        return ssl.create_default_context(cafile=cert)
+
+    def _session(self, server):
+        """Get or lazily create the session for a server"""
+        session = self._sessions.get(server)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ssl=self._ssl_for(self.servers[server].get('cert')),
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={'Content-Type': 'application/json'}
+            )
+            self._sessions[server] = session
+            self._limits[server] = asyncio.Semaphore(self.max_in_flight)
+        return session
+
+    def in_flight(self, server):
+        """Number of requests currently running against a server"""
+        return self._in_flight.get(server, 0)
+
+    def _notify(self, server, ok, latency):
+        for listener in self.listeners:
+            try:
+                listener(server, ok, latency)
+            except Exception as e:
+                logger.error("Outline transport listener error: %s", e)
+
+    async def post(self, server, payload):
+        """POST a JSON payload to a server, returns (status, body)"""
+        session = self._session(server)
+        self._in_flight[server] = self._in_flight.get(server, 0) + 1
+        started = time.monotonic()
+        ok = False
+        try:
+            async with self._limits[server]:
+                async with session.post(self.servers[server]['api_url'],
+                                        data=json.dumps(payload)) as response:
+                    text = await response.text()
+                    ok = response.status < 500
+                    try:
+                        body = json.loads(text)
+                    except ValueError:
+                        body = text
+                    return response.status, body
+        finally:
+            self._in_flight[server] -= 1
+            self._notify(server, ok, time.monotonic() - started)
+
+    async def close(self):
+        """Close all pooled connections"""
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            if not session.closed:
+                await session.close()
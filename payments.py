@@ -0,0 +1,344 @@
+import asyncio
+import heapq
+import hmac
+import logging
+import random
+import string
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentProvider:
+    """Interface of an external payment provider"""
+
+    def payment_url(self, payment_id, amount):
+        raise NotImplementedError
+
+    async def check(self, payment_ids):
+        """Return the subset of payment_ids that are paid"""
+        raise NotImplementedError
+
+    def parse_webhook(self, data):
+        """Return (payment_id, amount) paid according to a webhook body, or None"""
+        raise NotImplementedError
+
+
+class WebhookProvider(PaymentProvider):
+    """Provider that reports payments through its webhook only.
+
+    The payer is sent to `url` followed by the payment id. Polling never
+    confirms a payment, it stays unpaid until the webhook says so.
+    """
+
+    def __init__(self, url='https://example.com/pay/'):
+        self.url = url
+
+    def payment_url(self, payment_id, amount):
+        return f"{self.url}{payment_id}"
+
+    async def check(self, payment_ids):
+        return set()
+
+    def parse_webhook(self, data):
+        if data.get('status') != 'paid' or not data.get('payment_id'):
+            return None
+        try:
+            amount = float(data['amount'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        return str(data['payment_id']), amount
+
+
+def create_provider(name, url):
+    """Create payment provider by name"""
+    if name == 'webhook':
+        return WebhookProvider(url)
+    raise ValueError(f"Unknown payment provider: {name}")
+
+
+class PaymentService:
+    """Confirms payments off the request path and fulfils them once.
+
+    Confirmations come from the provider webhook or from a background
+    poller that checks pending payments in batches with exponential
+    backoff. Both feed one fulfillment queue; a payment is marked paid
+    before it is queued and completed after `fulfill` succeeds. Failed
+    fulfillments are retried with backoff, at most `max_attempts` times
+    in total, also across restarts; `fulfill` must make retries safe.
+
+    Unpaid invoices live for `ttl` seconds and are reused when the same
+    user asks again for the same server and duration. Expired invoices
+    are checked one last time, then deleted and passed to `on_expire`.
+    """
+
+    def __init__(self, storage, provider, fulfill, poll_interval=5, max_backoff=300,
+                 batch_size=100, workers=4, webhook_host='127.0.0.1', webhook_port=8080,
+                 webhook_path='/payments/webhook', webhook_secret='', ttl=3600, on_expire=None,
+                 max_attempts=5):
+        self.storage = storage
+        self.provider = provider
+        self.fulfill = fulfill
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.workers = workers
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.webhook_path = webhook_path
+        self.webhook_secret = webhook_secret
+        self._schedule = []   # (next_check, payment_id, attempts)
+        self._pending = set()
+        self._open = {}       # payment_id -> ((user_id, server, duration), amount)
+        self._invoices = {}   # (user_id, server, duration) -> payment_id
+        self._expiry = []     # (expires_at, payment_id)
+        self.pending_revenue = 0
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._wake = asyncio.Event()
+        self._tasks = []
+        self._runner = None
+
+    def payment_url(self, payment_id, amount):
+        return self.provider.payment_url(payment_id, amount)
+
+    @property
+    def pending_count(self):
+        return len(self._open)
+
+    def expires_at(self, payment):
+        return payment['date'].timestamp() + self.ttl
+
+    async def create(self, user_id, server, duration, amount):
+        """Open an invoice, reusing the user's unpaid one for the same purchase"""
+        invoice = (user_id, server, duration)
+        payment_id = self._invoices.get(invoice)
+        if payment_id is not None:
+            payment = await self.storage.get('payments', payment_id)
+            if payment is not None and not payment.get('paid') and time.time() < self.expires_at(payment):
+                return payment_id, payment
+
+        payment_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        payment = {
+            'user_id': user_id,
+            'server': server,
+            'duration': duration,
+            'amount': amount,
+            'date': datetime.now(),
+            'paid': False,
+            'completed': False
+        }
+        await self.storage.put('payments', payment_id, payment)
+        self._open_invoice(payment_id, payment)
+        self.track(payment_id)
+        return payment_id, payment
+
+    def _open_invoice(self, payment_id, payment):
+        invoice = (payment['user_id'], payment['server'], payment['duration'])
+        self._close_invoice(self._invoices.get(invoice))
+        self._open[payment_id] = (invoice, payment['amount'])
+        self._invoices[invoice] = payment_id
+        self.pending_revenue += payment['amount']
+        heapq.heappush(self._expiry, (self.expires_at(payment), payment_id))
+        self._wake.set()
+
+    def _close_invoice(self, payment_id):
+        entry = self._open.pop(payment_id, None)
+        if entry is None:
+            return
+        invoice, amount = entry
+        if self._invoices.get(invoice) == payment_id:
+            del self._invoices[invoice]
+        self.pending_revenue -= amount
+
+    def track(self, payment_id, attempts=0):
+        """Start polling a pending payment"""
+        self._pending.add(payment_id)
+        delay = min(self.max_backoff, self.poll_interval * 2 ** attempts)
+        heapq.heappush(self._schedule, (time.monotonic() + delay, payment_id, attempts))
+        self._wake.set()
+
+    def untrack(self, payment_id):
+        self._pending.discard(payment_id)
+
+    async def confirm(self, payment_id):
+        """Mark payment paid and queue it for fulfillment"""
+        payment = await self.storage.get('payments', payment_id)
+        if payment is None or payment.get('completed') or payment.get('failed'):
+            return False
+        self.untrack(payment_id)
+        self._close_invoice(payment_id)
+        if not payment.get('paid'):
+            payment['paid'] = True
+            await self.storage.put('payments', payment_id, payment, durable=True)
+        if payment_id not in self._queued:
+            self._queued.add(payment_id)
+            self._queue.put_nowait(payment_id)
+        return True
+
+    async def start(self):
+        """Recover state, start poller, workers and webhook server"""
+        for payment_id, payment in await self.storage.find('payments', completed=False):
+            if payment.get('paid'):
+                await self.confirm(payment_id)
+            else:
+                self._open_invoice(payment_id, payment)
+                self.track(payment_id)
+        self._tasks.append(asyncio.create_task(self._poll_loop()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._fulfill_loop()))
+
+        if self.webhook_port and not self.webhook_secret:
+            # Without a secret anyone reaching the port could confirm payments
+            logger.error("Payment webhook disabled: [Payments] webhook_secret is not set")
+        elif self.webhook_port:
+            app = web.Application()
+            app.router.add_post(self.webhook_path, self._handle_webhook)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, self.webhook_host, self.webhook_port)
+            await site.start()
+            logger.info(f"Payment webhook listening on {self.webhook_host}:{self.webhook_port}{self.webhook_path}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_webhook(self, request):
+        secret = request.headers.get('X-Webhook-Secret', '')
+        if not self.webhook_secret or not hmac.compare_digest(secret, self.webhook_secret):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        paid = self.provider.parse_webhook(data)
+        if paid is None:
+            return web.Response(text='ok')
+        payment_id, amount = paid
+        payment = await self.storage.get('payments', payment_id)
+        if payment is not None and amount != payment['amount']:
+            logger.error("Payment %s: webhook amount %s doesn't match %s", payment_id, amount, payment['amount'],
+                         extra={'user_id': payment['user_id']})
+            return web.Response(status=400)
+        await self.confirm(payment_id)
+        return web.Response(text='ok')
+
+    async def _poll_loop(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            due = []
+            while self._schedule and self._schedule[0][0] <= now and len(due) < self.batch_size:
+                _, payment_id, attempts = heapq.heappop(self._schedule)
+                if payment_id in self._pending:
+                    due.append((payment_id, attempts))
+
+            if due:
+                await self._poll(due)
+                continue
+
+            expired = []
+            wall = time.time()
+            while self._expiry and self._expiry[0][0] <= wall and len(expired) < self.batch_size:
+                _, payment_id = heapq.heappop(self._expiry)
+                if payment_id in self._open:
+                    expired.append(payment_id)
+
+            if expired:
+                await self._expire(expired)
+                continue
+
+            deadlines = []
+            if self._schedule:
+                deadlines.append(self._schedule[0][0] - now)
+            if self._expiry:
+                deadlines.append(self._expiry[0][0] - wall)
+            timeout = max(0, min(deadlines)) if deadlines else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, due):
+        try:
+            paid = await self.provider.check([payment_id for payment_id, _ in due])
+        except Exception as e:
+            logger.error("Payment provider check failed: %s", e)
+            paid = set()
+        for payment_id, attempts in due:
+            if payment_id in paid:
+                await self.confirm(payment_id)
+            else:
+                self.track(payment_id, attempts + 1)
+
+    async def _expire(self, payment_ids):
+        # Last check so that a payment made just before expiry is not lost
+        try:
+            paid = await self.provider.check(payment_ids)
+        except Exception as e:
+            logger.error("Payment provider check failed: %s", e)
+            for payment_id in payment_ids:
+                heapq.heappush(self._expiry, (time.time() + self.poll_interval, payment_id))
+            return
+        expired = 0
+        for payment_id in payment_ids:
+            if payment_id in paid:
+                await self.confirm(payment_id)
+                continue
+            payment = await self.storage.get('payments', payment_id)
+            self.untrack(payment_id)
+            self._close_invoice(payment_id)
+            if payment is None or payment.get('paid'):
+                continue
+            await self.storage.delete('payments', payment_id)
+            if self.on_expire is not None:
+                await self.on_expire(payment_id, payment)
+            expired += 1
+        logger.info("Expired %d unpaid payments", expired)
+
+    async def _fulfill(self, payment_id):
+        payment = await self.storage.get('payments', payment_id)
+        if payment is None or payment.get('completed') or payment.get('failed'):
+            return
+        # Counted before the attempt, so attempts cut short by a crash count too
+        payment['attempts'] = payment.get('attempts', 0) + 1
+        await self.storage.put('payments', payment_id, payment, durable=True)
+        try:
+            await self.fulfill(payment_id, payment)
+        except Exception as e:
+            attempts = payment['attempts']
+            if attempts >= self.max_attempts:
+                logger.error("Payment %s fulfillment failed %d times, giving up: %s", payment_id, attempts, e,
+                             extra={'user_id': payment['user_id']})
+                payment['failed'] = True
+                await self.storage.put('payments', payment_id, payment, durable=True)
+                return
+            logger.error("Payment %s fulfillment failed: %s", payment_id, e, extra={'user_id': payment['user_id']})
+            delay = min(self.max_backoff, self.poll_interval * 2 ** (attempts - 1))
+            asyncio.get_running_loop().call_later(
+                delay, lambda: asyncio.ensure_future(self.confirm(payment_id))
+            )
+            return
+        payment['completed'] = True
+        await self.storage.put('payments', payment_id, payment, durable=True)
+
+    async def _fulfill_loop(self):
+        while True:
+            payment_id = await self._queue.get()
+            try:
+                await self._fulfill(payment_id)
+            except Exception as e:
+                logger.error("Payment %s fulfillment error: %s", payment_id, e)
+            finally:
+                self._queued.discard(payment_id)
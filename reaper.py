@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryReaper:
+    """Revokes expired keys on the Outline servers in the background.
+
+    Sleeps until the next key in the KeyIndex is due instead of polling,
+    then revokes due keys per server with bounded concurrency. Failed
+    revocations are retried with exponential backoff.
+    """
+
+    def __init__(self, key_index, storage, revoke, concurrency=4, batch_size=100,
+                 retry_delay=30, max_retries=6, max_sleep=3600):
+        self.key_index = key_index
+        self.storage = storage
+        self.revoke = revoke
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.max_sleep = max_sleep
+        self._due = {}      # server -> {key: attempts}
+        self._retries = []  # (when, key, server, attempts)
+        self._next_wakeup = None
+        self._wake = asyncio.Event()
+        key_index.listeners.append(self._on_expire)
+
+    def _on_expire(self, expired):
+        for key, (_, server, _) in expired:
+            self.schedule(key, server)
+
+    def schedule(self, key, server, attempts=0):
+        """Queue a key for revocation"""
+        self._due.setdefault(server, {})[key] = attempts
+        self._wake.set()
+
+    def notify(self, expiry):
+        """Wake the reaper if a key expires before its next wakeup"""
+        if self._next_wakeup is None or expiry < self._next_wakeup:
+            self._wake.set()
+
+    async def run(self):
+        """Reaper loop"""
+        while True:
+            self._wake.clear()
+            now = datetime.now()
+            self.key_index.advance(now)
+            while self._retries and self._retries[0][0] <= now:
+                _, key, server, attempts = heapq.heappop(self._retries)
+                self._due.setdefault(server, {})[key] = attempts
+
+            if self._due:
+                due, self._due = self._due, {}
+                try:
+                    await self._reap(due)
+                except Exception as e:
+                    logger.error("Reaper error: %s", e)
+                continue
+
+            candidates = [self.key_index.next_expiry()]
+            if self._retries:
+                candidates.append(self._retries[0][0])
+            candidates = [c for c in candidates if c is not None]
+            self._next_wakeup = min(candidates) if candidates else None
+
+            timeout = self.max_sleep
+            if self._next_wakeup is not None:
+                timeout = min(timeout, max(0, (self._next_wakeup - now).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _reap(self, due):
+        tasks = [self._reap_server(server, keys) for server, keys in due.items()]
+        await asyncio.gather(*tasks)
+
+    async def _reap_server(self, server, keys):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        items = list(keys.items())
+        revoked = 0
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            results = await asyncio.gather(
+                *[self._reap_key(semaphore, server, key, attempts) for key, attempts in batch]
+            )
+            revoked += sum(results)
+        logger.info("Reaped %d/%d expired keys on %s", revoked, len(items), server)
+
+    async def _reap_key(self, semaphore, server, key, attempts):
+        data = await self.storage.get('keys', key)
+        if data is None:
+            return True
+        if key in self.key_index:
+            # Key was renewed meanwhile
+            return False
+
+        key_id = data.get('key_id')
+        if key_id is not None:
+            async with semaphore:
+                ok = await self.revoke(key_id, data.get('node') or server)
+            if not ok:
+                self._retry(key, server, attempts + 1)
+                return False
+
+        await self.storage.delete('keys', key)
+        return True
+
+    def _retry(self, key, server, attempts):
+        if attempts >= self.max_retries:
+            # Left in storage, picked up again on next start
+            logger.error("Giving up revoking key on %s after %d attempts", server, attempts, extra={'server': server})
+            return
+        delay = timedelta(seconds=self.retry_delay * 2 ** (attempts - 1))
+        heapq.heappush(self._retries, (datetime.now() + delay, key, server, attempts))
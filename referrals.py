@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from stats import MIGRATIONS
+
+logger = logging.getLogger(__name__)
+
+
+class ReferralStore:
+    """Referral edges with cached counters.
+
+    Each referred user has at most one edge, saved in the `referrals`
+    collection under the user's id, so a repeated `/start ref_...` can't
+    count twice. The parent map is kept in memory for ancestry lookups
+    and per-referrer counts are kept for the referrers this process owns.
+    """
+
+    def __init__(self, storage, owns=lambda user_id: True):
+        self.storage = storage
+        self.owns = owns
+        self._parents = {}   # referred user -> referrer
+        self._counts = {}    # referrer -> number of referrals
+
+    async def load(self):
+        """Load edges, building them from users' referral_by on first run"""
+        migrations = await self.storage.get('stats', MIGRATIONS) or {}
+        if not migrations.get('referrals'):
+            if not await self.storage.count('referrals'):
+                await self._migrate()
+            # Marked even if nobody was referred, so users are scanned once
+            migrations['referrals'] = True
+            await self.storage.put('stats', MIGRATIONS, migrations, durable=True)
+
+        async for user_id, edge in self.storage.scan('referrals'):
+            self._remember(user_id, edge['referrer'])
+        logger.info(f"Loaded {len(self._parents)} referral edges")
+
+    async def _migrate(self):
+        migrated = 0
+        async for user_id, user in self.storage.scan('users'):
+            if user.get('referral_by'):
+                await self.storage.put('referrals', user_id, {
+                    'referrer': user['referral_by'],
+                    'date': user.get('registered') or datetime.now()
+                })
+                migrated += 1
+        if migrated:
+            await self.storage.flush()
+            logger.info(f"Referrals: migrated {migrated} edges from users")
+
+    def _remember(self, user_id, referrer):
+        self._parents[user_id] = referrer
+        if self.owns(referrer):
+            self._counts[referrer] = self._counts.get(referrer, 0) + 1
+
+    def count(self, referrer):
+        """Number of users invited by referrer"""
+        return self._counts.get(referrer, 0)
+
+    async def add(self, referrer, user_id):
+        """Save an edge, False if the user already has a referrer"""
+        if await self.referrer(user_id) is not None:
+            return False
+        await self.storage.put('referrals', user_id, {'referrer': referrer, 'date': datetime.now()})
+        self._remember(user_id, referrer)
+        return True
+
+    async def referrer(self, user_id):
+        """Referrer of a user, or None"""
+        referrer = self._parents.get(user_id)
+        if referrer is None:
+            # Added by another process of a cluster
+            edge = await self.storage.get('referrals', user_id)
+            if edge is not None:
+                referrer = self._parents[user_id] = edge['referrer']
+        return referrer
+
+    async def ancestors(self, user_id, depth):
+        """Referrer chain of a user, nearest first, at most `depth` long"""
+        chain = []
+        seen = {user_id}
+        while len(chain) < depth:
+            user_id = await self.referrer(user_id)
+            if user_id is None or user_id in seen:
+                break
+            chain.append(user_id)
+            seen.add(user_id)
+        return chain
+
+
+class ReferralNotifier:
+    """Sends referral bonus notifications off the buyer's path.
+
+    `notify` only records the bonus. The referrer gets a message
+    `delay` seconds after their first pending bonus, so a burst of
+    signups or purchases becomes one digest instead of a message each.
+    """
+
+    def __init__(self, send, delay=5, workers=2):
+        self.send = send
+        self.delay = delay
+        self.workers = workers
+        self._pending = {}   # referrer -> [(kind, amount)], balance
+        self._queue = asyncio.Queue()
+        self._tasks = []
+
+    def notify(self, referrer, kind, amount, balance):
+        """Queue a 'signup' or 'purchase' bonus for referrer"""
+        entry = self._pending.get(referrer)
+        if entry is None:
+            entry = self._pending[referrer] = [[], balance]
+            asyncio.get_running_loop().call_later(self.delay, self._queue.put_nowait, referrer)
+        entry[0].append((kind, amount))
+        entry[1] = balance
+
+    @staticmethod
+    def format(bonuses, balance):
+        if len(bonuses) == 1:
+            kind, amount = bonuses[0]
+            if kind == 'signup':
+                return (f"🎉 Новый реферал! Вам начислено {amount} руб. бонуса.\n"
+                        f"Ваш баланс: {balance} руб.")
+            return (f"💰 Ваш реферал совершил покупку! Вам начислено {amount} руб.\n"
+                    f"Ваш баланс: {balance} руб.")
+        signups = sum(1 for kind, _ in bonuses if kind == 'signup')
+        message = "💰 Реферальные начисления:\n\n"
+        if signups:
+            message += f"🎉 Новых рефералов: {signups}\n"
+        if len(bonuses) > signups:
+            message += f"🛒 Покупок рефералов: {len(bonuses) - signups}\n"
+        return message + (f"\nВам начислено {sum(amount for _, amount in bonuses)} руб.\n"
+                          f"Ваш баланс: {balance} руб.")
+
+    async def _deliver(self, referrer):
+        entry = self._pending.pop(referrer, None)
+        if entry is None:
+            return
+        bonuses, balance = entry
+        try:
+            await self.send(referrer, self.format(bonuses, balance))
+        except Exception as e:
+            logger.error("Failed to notify referrer %s: %s", referrer, e, extra={'user_id': referrer})
+
+    async def _worker(self):
+        while True:
+            referrer = await self._queue.get()
+            await self._deliver(referrer)
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        """Stop workers and send what is still pending"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for referrer in list(self._pending):
+            await self._deliver(referrer)
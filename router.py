@@ -0,0 +1,66 @@
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackRouter:
+    """Table-driven dispatcher for inline button callbacks.
+
+    Callback data looks like `<route>_<param>_<param>`, where the route
+    name may itself contain underscores (`pay_balance_EU_30`). The data is
+    decoded and split once, then the longest matching route name is looked
+    up in a dict. The number of lookups is bounded by the deepest route
+    name, so dispatch cost does not grow with the number of routes.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._depth = 1
+
+    def route(self, name, *converters):
+        """Register handler(event, *params) for a route with typed params"""
+        def decorator(func):
+            self._routes[name] = (func, converters)
+            self._depth = max(self._depth, name.count('_') + 1)
+            return func
+        return decorator
+
+    def wrap(self, wrapper):
+        """Replace every handler with wrapper(name, handler)"""
+        for name, (func, converters) in self._routes.items():
+            # Wrap the original handler when called again
+            func = inspect.unwrap(func)
+            self._routes[name] = (wrapper(name, func), converters)
+
+    def resolve(self, data):
+        """Parse callback data into (handler, params) or None"""
+        try:
+            parts = data.decode('utf-8').split('_')
+        except UnicodeDecodeError:
+            return None
+
+        for depth in range(min(self._depth, len(parts)), 0, -1):
+            route = self._routes.get('_'.join(parts[:depth]))
+            if route is None:
+                continue
+            func, converters = route
+            raw = parts[depth:]
+            if len(raw) != len(converters):
+                return None
+            try:
+                params = [convert(value) for convert, value in zip(converters, raw)]
+            except ValueError:
+                return None
+            return func, params
+        return None
+
+    async def dispatch(self, event):
+        """Run the handler for a callback event"""
+        resolved = self.resolve(event.data)
+        if resolved is None:
+            logger.warning("Unknown callback data: %r", event.data)
+            await event.answer()
+            return
+        func, params = resolved
+        await func(event, *params)
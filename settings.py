@@ -0,0 +1,129 @@
+import configparser
+from dataclasses import dataclass, field
+
+# Region -> config key prefix. Extra servers of a region use numbered keys:
+# us_api_url_2 / us_api_cert_2 become server 'US2' in region 'US'.
+OUTLINE_REGION_PREFIXES = {'EU': '', 'US': 'us_', 'ASIA': 'asia_'}
+
+
+@dataclass
+class OutlineSettings:
+    servers: dict = field(default_factory=dict)
+    regions: dict = field(default_factory=dict)
+    connect_timeout: float = 3
+    read_timeout: float = 10
+    max_in_flight: int = 8
+    reaper_concurrency: int = 4
+    probe_interval: float = 30
+    failure_threshold: int = 3
+    reset_timeout: float = 30
+    pool_low: int = 5
+    pool_high: int = 20
+    usage_interval: float = 300
+
+
+@dataclass
+class PaymentSettings:
+    provider: str = 'webhook'
+    url: str = 'https://example.com/pay/'
+    poll_interval: float = 5
+    ttl: int = 3600
+    webhook_host: str = '127.0.0.1'
+    webhook_port: int = 8080
+    webhook_path: str = '/payments/webhook'
+    webhook_secret: str = ''
+
+
+@dataclass
+class Settings:
+    """Bot configuration, parsed once from config.ini"""
+    api_id: int
+    api_hash: str
+    bot_token: str
+    admin_ids: list
+    outline: OutlineSettings = field(default_factory=OutlineSettings)
+    payments: PaymentSettings = field(default_factory=PaymentSettings)
+    storage_backend: str = 'sqlite'
+    storage_path: str = 'vpn_bot.db'
+    send_rate: float = 25
+    chat_send_interval: float = 1
+    broadcast_rate: float = 25
+    broadcast_concurrency: int = 10
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 9100
+    log_level: str = 'INFO'
+    log_format: str = 'json'
+
+
+def load_outline_servers(config):
+    """Read Outline servers and their regions from config"""
+    servers = {}
+    regions = {}
+    for region, prefix in OUTLINE_REGION_PREFIXES.items():
+        regions[region] = []
+        index = 1
+        while True:
+            suffix = '' if index == 1 else f'_{index}'
+            api_url = config.get('Outline', f'{prefix}api_url{suffix}', fallback='')
+            if not api_url:
+                break
+            server = region if index == 1 else f'{region}{index}'
+            servers[server] = {
+                'api_url': api_url,
+                'cert': config.get('Outline', f'{prefix}api_cert{suffix}', fallback=None)
+            }
+            regions[region].append(server)
+            index += 1
+    return servers, regions
+
+
+def load_settings(path='config.ini'):
+    """Parse config file into Settings"""
+    # The documented config.ini has comments after values
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    with open(path) as fh:
+        config.read_file(fh)
+
+    servers, regions = load_outline_servers(config)
+    return Settings(
+        api_id=config.getint('Telegram', 'API_ID'),
+        api_hash=config['Telegram']['api_hash'],
+        bot_token=config['Telegram']['BOT_TOKEN'],
+        admin_ids=[int(id) for id in config['Telegram']['admin_ids'].split(',')],
+        outline=OutlineSettings(
+            servers=servers,
+            regions=regions,
+            connect_timeout=config.getfloat('Outline', 'connect_timeout', fallback=3),
+            read_timeout=config.getfloat('Outline', 'read_timeout', fallback=10),
+            max_in_flight=config.getint('Outline', 'max_in_flight', fallback=8),
+            reaper_concurrency=config.getint('Outline', 'reaper_concurrency', fallback=4),
+            probe_interval=config.getfloat('Outline', 'probe_interval', fallback=30),
+            failure_threshold=config.getint('Outline', 'failure_threshold', fallback=3),
+            reset_timeout=config.getfloat('Outline', 'reset_timeout', fallback=30),
+            pool_low=config.getint('Outline', 'pool_low', fallback=5),
+            pool_high=config.getint('Outline', 'pool_high', fallback=20),
+            usage_interval=config.getfloat('Outline', 'usage_interval', fallback=300)
+        ),
+        payments=PaymentSettings(
+            provider=config.get('Payments', 'provider', fallback='webhook'),
+            url=config.get('Payments', 'url', fallback='https://example.com/pay/'),
+            poll_interval=config.getfloat('Payments', 'poll_interval', fallback=5),
+            ttl=config.getint('Payments', 'ttl', fallback=3600),
+            webhook_host=config.get('Payments', 'webhook_host', fallback='127.0.0.1'),
+            webhook_port=config.getint('Payments', 'webhook_port', fallback=8080),
+            webhook_path=config.get('Payments', 'webhook_path', fallback='/payments/webhook'),
+            webhook_secret=config.get('Payments', 'webhook_secret', fallback='')
+        ),
+        storage_backend=config.get('Storage', 'backend', fallback='sqlite'),
+        storage_path=config.get('Storage', 'path', fallback='vpn_bot.db'),
+        # Telegram allows about 30 messages per second for bots
+        send_rate=config.getfloat('Telegram', 'send_rate', fallback=25),
+        # and about one message per second to the same chat
+        chat_send_interval=config.getfloat('Telegram', 'chat_send_interval', fallback=1),
+        broadcast_rate=config.getfloat('Broadcast', 'rate', fallback=25),
+        broadcast_concurrency=config.getint('Broadcast', 'concurrency', fallback=10),
+        metrics_host=config.get('Metrics', 'host', fallback='127.0.0.1'),
+        metrics_port=config.getint('Metrics', 'port', fallback=9100),
+        log_level=config.get('Logging', 'level', fallback='INFO'),
+        log_format=config.get('Logging', 'format', fallback='json')
+    )
@@ -0,0 +1,111 @@
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Document of the `stats` collection recording finished data migrations
+MIGRATIONS = 'migrations'
+
+
+def _empty_day():
+    return {'registrations': 0, 'sales': 0, 'revenue': 0, 'abandoned': 0, 'abandoned_amount': 0, 'servers': {}}
+
+
+class Stats:
+    """Incremental counters for the admin panels.
+
+    Totals and day-bucketed rollups are updated on every registration,
+    purchase and completed payment and saved to the `stats` collection,
+    so rendering the panels never rescans users or payments. Expired
+    unpaid payments are only kept here, as abandoned counts.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.total = {'users': 0, 'sales': 0, 'revenue': 0, 'abandoned': 0, 'abandoned_amount': 0}
+        self.days = {}
+
+    @staticmethod
+    def _day_id(when):
+        return when.strftime('%Y-%m-%d')
+
+    def day(self, when):
+        """Rollup bucket for the day of `when`"""
+        day_id = self._day_id(when)
+        bucket = self.days.get(day_id)
+        if bucket is None:
+            bucket = self.days[day_id] = _empty_day()
+        return bucket
+
+    async def _save(self, day_id):
+        await self.storage.put('stats', 'total', self.total)
+        await self.storage.put('stats', day_id, self.days[day_id])
+
+    async def record_registration(self, when=None):
+        when = when or datetime.now()
+        self.total['users'] += 1
+        self.day(when)['registrations'] += 1
+        await self._save(self._day_id(when))
+
+    async def record_sale(self, server, revenue=0, when=None):
+        """Count a purchase, `revenue` is money actually paid (not balance)"""
+        when = when or datetime.now()
+        bucket = self.day(when)
+        server_bucket = bucket['servers'].setdefault(server, {'sales': 0, 'revenue': 0})
+        self.total['sales'] += 1
+        self.total['revenue'] += revenue
+        bucket['sales'] += 1
+        bucket['revenue'] += revenue
+        server_bucket['sales'] += 1
+        server_bucket['revenue'] += revenue
+        await self._save(self._day_id(when))
+
+    async def record_abandoned(self, amount, when=None):
+        """Archive an expired unpaid payment"""
+        when = when or datetime.now()
+        bucket = self.day(when)
+        for counters in (self.total, bucket):
+            counters['abandoned'] = counters.get('abandoned', 0) + 1
+            counters['abandoned_amount'] = counters.get('abandoned_amount', 0) + amount
+        await self._save(self._day_id(when))
+
+    def history(self, days=7, now=None):
+        """[(date, bucket)] for the last `days` days, newest first"""
+        now = now or datetime.now()
+        result = []
+        for offset in range(days):
+            date = now - timedelta(days=offset)
+            result.append((date, self.days.get(self._day_id(date), _empty_day())))
+        return result
+
+    async def load(self):
+        """Load rollups from storage, bootstrapping them on first run"""
+        async for doc_id, doc in self.storage.scan('stats'):
+            if doc_id == 'total':
+                self.total.update(doc)
+            elif doc_id != MIGRATIONS:
+                self.days[doc_id] = {**_empty_day(), **doc}
+        if self.days or self.total['users']:
+            return
+        await self._bootstrap()
+
+    async def _bootstrap(self):
+        """One-time rebuild from users and completed payments"""
+        async for _, user in self.storage.scan('users'):
+            self.total['users'] += 1
+            self.total['sales'] += user.get('purchases', 0)
+            self.day(user['registered'])['registrations'] += 1
+        async for _, payment in self.storage.scan('payments'):
+            if not payment.get('completed'):
+                continue
+            bucket = self.day(payment['date'])
+            server_bucket = bucket['servers'].setdefault(payment['server'], {'sales': 0, 'revenue': 0})
+            bucket['sales'] += 1
+            bucket['revenue'] += payment['amount']
+            server_bucket['sales'] += 1
+            server_bucket['revenue'] += payment['amount']
+            self.total['revenue'] += payment['amount']
+        await self.storage.put('stats', 'total', self.total)
+        for day_id, bucket in self.days.items():
+            await self.storage.put('stats', day_id, bucket)
+        logger.info(f"Stats rebuilt: {self.total['users']} users, {len(self.days)} days")
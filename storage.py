@@ -0,0 +1,707 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Collections and the document fields mirrored into indexed columns
+COLLECTIONS = {
+    'users': {'registered': 'REAL'},
+    'keys': {'user_id': 'INTEGER', 'expiry': 'REAL'},
+    'payments': {'user_id': 'INTEGER', 'date': 'REAL', 'completed': 'INTEGER'},
+    'broadcasts': {'done': 'INTEGER'},
+    'stats': {},
+    'pool': {},
+    'referrals': {'referrer': 'INTEGER'},
+}
+
+OPERATORS = {'eq': '=', 'gt': '>', 'ge': '>=', 'lt': '<', 'le': '<='}
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+def encode(doc):
+    """Serialize document to JSON text"""
+    return json.dumps(doc, default=_default, ensure_ascii=False)
+
+
+def decode(text):
+    """Deserialize document from JSON text"""
+    return json.loads(text, object_hook=_object_hook)
+
+
+def _column_value(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return value
+
+
+def parse_filters(filters):
+    """Split Django-style filters (expiry__gt=...) into (field, op, value)"""
+    parsed = []
+    for name, value in filters.items():
+        field, _, op = name.partition('__')
+        parsed.append((field, op or 'eq', value))
+    return parsed
+
+
+def matches(doc, parsed):
+    """Check document against parsed filters"""
+    for field, op, value in parsed:
+        current = doc.get(field)
+        if current is None:
+            return False
+        if op == 'eq' and not current == value:
+            return False
+        if op == 'gt' and not current > value:
+            return False
+        if op == 'ge' and not current >= value:
+            return False
+        if op == 'lt' and not current < value:
+            return False
+        if op == 'le' and not current <= value:
+            return False
+    return True
+
+
+class Storage:
+    """Base class for storage backends.
+
+    Documents are plain dicts addressed by (collection, id). `get` returns
+    the live cached document, so handlers mutate it in place and then
+    call `put` to persist the change.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def get(self, collection, doc_id):
+        raise NotImplementedError
+
+    async def put(self, collection, doc_id, doc, durable=False):
+        raise NotImplementedError
+
+    async def delete(self, collection, doc_id, durable=False):
+        raise NotImplementedError
+
+    async def find(self, collection, **filters):
+        """Return [(id, doc)] matching indexed-field filters"""
+        raise NotImplementedError
+
+    async def count(self, collection, **filters):
+        raise NotImplementedError
+
+    async def scan(self, collection):
+        """Iterate over all (id, doc) pairs of a collection"""
+        raise NotImplementedError
+        yield
+
+    async def ids(self, collection):
+        """Iterate over all document ids of a collection"""
+        async for doc_id, _ in self.scan(collection):
+            yield doc_id
+
+
+class MemoryStorage(Storage):
+    """Volatile dict-backed storage, used for offline runs"""
+
+    def __init__(self):
+        self.data = {name: {} for name in COLLECTIONS}
+
+    async def get(self, collection, doc_id):
+        return self.data[collection].get(doc_id)
+
+    async def put(self, collection, doc_id, doc, durable=False):
+        self.data[collection][doc_id] = doc
+
+    async def delete(self, collection, doc_id, durable=False):
+        self.data[collection].pop(doc_id, None)
+
+    async def find(self, collection, **filters):
+        parsed = parse_filters(filters)
+        return [(doc_id, doc) for doc_id, doc in self.data[collection].items()
+                if matches(doc, parsed)]
+
+    async def count(self, collection, **filters):
+        if not filters:
+            return len(self.data[collection])
+        return len(await self.find(collection, **filters))
+
+    async def scan(self, collection):
+        for doc_id, doc in list(self.data[collection].items()):
+            yield doc_id, doc
+
+
+class GroupCommitStorage(Storage):
+    """Base of backends that write on one dedicated thread.
+
+    Writes are coalesced per document and group-committed: the flusher
+    hands a burst of puts to `_write` at once, so many clicks share one
+    fsync. A put with `durable=True` returns once its batch is written.
+    """
+
+    def __init__(self, flush_interval=0.05, batch_size=500, thread_name='storage'):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name)
+        self._dirty = {}
+        self._waiters = []
+        self._wake = None
+        self._flusher = None
+        self._open_lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _load(self):
+        """Prepare the backend, called once by open()"""
+        raise NotImplementedError
+
+    async def _write(self, dirty):
+        """Persist a batch of {(collection, id): doc, or None if deleted}"""
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    async def open(self):
+        if self._flusher is not None:
+            return
+        async with self._open_lock:
+            if self._flusher is not None:
+                return
+            await self._load()
+            self._wake = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flusher is None:
+            return
+        await self.flush()
+        self._flusher.cancel()
+        self._flusher = None
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    async def _flush_loop(self):
+        while True:
+            await self._wake.wait()
+            if len(self._dirty) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                await self._commit()
+            except Exception as e:
+                logger.error("Storage flush error: %s", e)
+                await asyncio.sleep(1)
+                self._wake.set()
+
+    async def _commit(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        waiters, self._waiters = self._waiters, []
+        try:
+            await self._write(dirty)
+        except Exception:
+            # Keep the batch so it is retried, newer writes win
+            for key, doc in dirty.items():
+                self._dirty.setdefault(key, doc)
+            self._waiters.extend(waiters)
+            raise
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+
+    async def flush(self):
+        """Write all pending changes now"""
+        if self._flusher is None:
+            return
+        await self._commit()
+
+    async def _schedule(self, collection, doc_id, doc, durable):
+        await self.open()
+        self._dirty[(collection, doc_id)] = doc
+        if durable:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        self._wake.set()
+        if durable:
+            await waiter
+
+
+class SQLiteStorage(GroupCommitStorage):
+    """Embedded SQLite storage in WAL mode.
+
+    All SQL runs on one dedicated thread and a burst of puts is written
+    in one transaction.
+    """
+
+    def __init__(self, path, flush_interval=0.05, batch_size=500, page_size=1000):
+        super().__init__(flush_interval, batch_size)
+        self.path = path
+        self.page_size = page_size
+        self._conn = None
+        self._cache = {name: {} for name in COLLECTIONS}
+
+    # ---- executor side ---- #
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        for name, columns in COLLECTIONS.items():
+            extra = ''.join(f', {column} {kind}' for column, kind in columns.items())
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {name} (id PRIMARY KEY, data TEXT NOT NULL{extra})')
+            self._add_columns(conn, name, columns)
+            for column in columns:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_{column} ON {name}({column})')
+        conn.commit()
+        self._conn = conn
+
+    def _add_columns(self, conn, name, columns):
+        """Add indexed columns introduced after the table was created"""
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({name})')}
+        missing = [column for column in columns if column not in existing]
+        if not missing:
+            return
+        for column in missing:
+            conn.execute(f'ALTER TABLE {name} ADD COLUMN {column} {columns[column]}')
+        rows = conn.execute(f'SELECT id, data FROM {name}').fetchall()
+        for doc_id, text in rows:
+            doc = decode(text)
+            values = [_column_value(doc.get(column)) for column in missing]
+            assignments = ', '.join(f'{column} = ?' for column in missing)
+            conn.execute(f'UPDATE {name} SET {assignments} WHERE id = ?', (*values, doc_id))
+        logger.info(f"Storage: added {', '.join(missing)} to {name}")
+
+    def _write_batch(self, rows):
+        with self._conn:
+            for collection, doc_id, text, values in rows:
+                if text is None:
+                    self._conn.execute(f'DELETE FROM {collection} WHERE id = ?', (doc_id,))
+                    continue
+                columns = COLLECTIONS[collection]
+                names = ''.join(f', {column}' for column in columns)
+                marks = ', ?' * len(columns)
+                self._conn.execute(
+                    f'INSERT OR REPLACE INTO {collection} (id, data{names}) VALUES (?, ?{marks})',
+                    (doc_id, text, *values)
+                )
+
+    def _select(self, sql, params=()):
+        return self._conn.execute(sql, params).fetchall()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ---- event loop side ---- #
+
+    async def _load(self):
+        await self._run(self._connect)
+        logger.info(f"Storage opened: {self.path}")
+
+    async def _write(self, dirty):
+        rows = []
+        for (collection, doc_id), doc in dirty.items():
+            if doc is None:
+                rows.append((collection, doc_id, None, ()))
+                continue
+            values = tuple(_column_value(doc.get(column)) for column in COLLECTIONS[collection])
+            rows.append((collection, doc_id, encode(doc), values))
+        await self._run(self._write_batch, rows)
+
+    async def get(self, collection, doc_id):
+        cache = self._cache[collection]
+        doc = cache.get(doc_id)
+        if doc is not None:
+            return doc
+        key = (collection, doc_id)
+        if key in self._dirty:
+            return self._dirty[key]
+        await self.open()
+        rows = await self._run(self._select, f'SELECT data FROM {collection} WHERE id = ?', (doc_id,))
+        if not rows:
+            return None
+        # Another coroutine may have loaded it meanwhile, keep one live copy
+        return cache.setdefault(doc_id, decode(rows[0][0]))
+
+    async def put(self, collection, doc_id, doc, durable=False):
+        self._cache[collection][doc_id] = doc
+        await self._schedule(collection, doc_id, doc, durable)
+
+    async def delete(self, collection, doc_id, durable=False):
+        self._cache[collection].pop(doc_id, None)
+        await self._schedule(collection, doc_id, None, durable)
+
+    def _where(self, collection, filters):
+        clauses = []
+        params = []
+        for field, op, value in parse_filters(filters):
+            if field != 'id' and field not in COLLECTIONS[collection]:
+                raise ValueError(f"{collection}.{field} is not indexed")
+            clauses.append(f'{field} {OPERATORS[op]} ?')
+            params.append(_column_value(value))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        return where, params
+
+    def _document(self, collection, doc_id, text):
+        # Rows read in bulk are not added to the cache, or a scan would
+        # keep the whole table in memory; cached documents stay the live copy
+        doc = self._cache[collection].get(doc_id)
+        return doc if doc is not None else decode(text)
+
+    async def find(self, collection, **filters):
+        await self.open()
+        await self.flush()
+        where, params = self._where(collection, filters)
+        rows = await self._run(self._select, f'SELECT id, data FROM {collection}{where}', params)
+        return [(doc_id, self._document(collection, doc_id, text)) for doc_id, text in rows]
+
+    async def count(self, collection, **filters):
+        await self.open()
+        await self.flush()
+        where, params = self._where(collection, filters)
+        rows = await self._run(self._select, f'SELECT COUNT(*) FROM {collection}{where}', params)
+        return rows[0][0]
+
+    async def scan(self, collection):
+        await self.open()
+        await self.flush()
+        last = 0
+        while True:
+            rows = await self._run(
+                self._select,
+                f'SELECT rowid, id, data FROM {collection} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last, self.page_size)
+            )
+            if not rows:
+                return
+            for rowid, doc_id, text in rows:
+                last = rowid
+                yield doc_id, self._document(collection, doc_id, text)
+
+    async def ids(self, collection):
+        await self.open()
+        await self.flush()
+        last = 0
+        while True:
+            rows = await self._run(
+                self._select,
+                f'SELECT rowid, id FROM {collection} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last, self.page_size)
+            )
+            if not rows:
+                return
+            for rowid, doc_id in rows:
+                last = rowid
+                yield doc_id
+
+
+class JournalStorage(GroupCommitStorage, MemoryStorage):
+    """In-memory storage persisted by a write-ahead journal and snapshots.
+
+    All documents live in memory, as with MemoryStorage. Changes are
+    coalesced per document and appended to the journal as whole documents,
+    one fsync per batch on a writer thread, so clicks don't wait for the
+    disk unless `durable` is set. When the journal outgrows
+    `snapshot_bytes`, a new journal segment is started and every document
+    is written to a compacted snapshot in the background. On open the
+    snapshot is loaded and the newer segments are replayed over it.
+    """
+
+    def __init__(self, path, flush_interval=0.05, batch_size=500,
+                 snapshot_bytes=64 * 1024 * 1024, chunk_size=2000):
+        MemoryStorage.__init__(self)
+        GroupCommitStorage.__init__(self, flush_interval, batch_size, 'journal')
+        self.path = path
+        self.snapshot_bytes = snapshot_bytes
+        self.chunk_size = chunk_size
+        self._snapshot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+        self._journal = None
+        self._segment = 0
+        self._journal_bytes = 0
+        self._snapshotter = None
+
+    async def _run_snapshot(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._snapshot_executor, func, *args)
+
+    @property
+    def _snapshot_path(self):
+        return f'{self.path}.snapshot'
+
+    def _segment_path(self, segment):
+        return f'{self.path}.{segment:06d}.journal'
+
+    # ---- executor side ---- #
+
+    def _segments(self):
+        directory, prefix = os.path.split(self.path)
+        segments = []
+        for name in os.listdir(directory or '.'):
+            number = name[len(prefix) + 1:-len('.journal')]
+            if name.startswith(prefix + '.') and name.endswith('.journal') and number.isdigit():
+                segments.append(int(number))
+        return sorted(segments)
+
+    def _recover(self):
+        """Load the snapshot and replay newer segments, returns the next segment"""
+        data = {name: {} for name in COLLECTIONS}
+        first = 0
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, encoding='utf-8') as fh:
+                first = json.loads(fh.readline())['journal']
+                for line in fh:
+                    collection, doc_id, doc = decode(line)
+                    data[collection][doc_id] = doc
+        segments = self._segments()
+        replayed = 0
+        for segment in segments:
+            path = self._segment_path(segment)
+            if segment < first:
+                # Already in the snapshot, left by an interrupted compaction
+                os.remove(path)
+                continue
+            with open(path, encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        collection, doc_id, doc = decode(line)
+                    except ValueError:
+                        # Torn write of the last batch before a crash
+                        logger.warning(f"Storage: skipped a broken record in {path}")
+                        break
+                    if doc is None:
+                        data[collection].pop(doc_id, None)
+                    else:
+                        data[collection][doc_id] = doc
+                    replayed += 1
+        self.data = data
+        return max([first - 1, *segments]) + 1, replayed
+
+    def _open_segment(self, segment):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._segment_path(segment), 'a', encoding='utf-8')
+        self._sync_directory()
+
+    def _append(self, text):
+        self._journal.write(text)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _sync_directory(self):
+        fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _create_snapshot(self, segment):
+        fh = open(self._snapshot_path + '.tmp', 'w', encoding='utf-8')
+        fh.write(json.dumps({'journal': segment}) + '\n')
+        return fh
+
+    def _finish_snapshot(self, fh, segment):
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.replace(fh.name, self._snapshot_path)
+        self._sync_directory()
+        for old in self._segments():
+            if old < segment:
+                os.remove(self._segment_path(old))
+
+    def _close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    # ---- event loop side ---- #
+
+    async def _load(self):
+        started = time.monotonic()
+        # Recovery runs before anything else touches the data. The
+        # collector is paused while millions of documents are decoded.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._segment, replayed = await self._run(self._recover)
+        finally:
+            if collecting:
+                gc.enable()
+        await self._run(self._open_segment, self._segment)
+        documents = sum(len(docs) for docs in self.data.values())
+        logger.info(f"Storage opened: {self.path}, {documents} documents, "
+                    f"{replayed} journal records replayed in {time.monotonic() - started:.1f}s")
+
+    async def close(self):
+        if self._flusher is None:
+            return
+        if self._snapshotter is not None:
+            await asyncio.shield(self._snapshotter)
+        await super().close()
+        self._snapshot_executor.shutdown(wait=False)
+
+    async def _write(self, dirty):
+        text = ''.join(encode([collection, doc_id, doc]) + '\n'
+                       for (collection, doc_id), doc in dirty.items())
+        await self._run(self._append, text)
+        self._journal_bytes += len(text)
+        if self._journal_bytes >= self.snapshot_bytes and self._snapshotter is None:
+            self._snapshotter = asyncio.create_task(self.snapshot())
+
+    async def snapshot(self):
+        """Compact the journal into a new snapshot.
+
+        Changes made while the snapshot is written go to the new segment
+        and may also be in the snapshot; replaying whole documents over
+        it gives the same result.
+        """
+        try:
+            await self._commit()
+            segment = self._segment + 1
+            await self._run(self._open_segment, segment)
+            self._segment = segment
+            self._journal_bytes = 0
+            started = time.monotonic()
+            # Only ids are copied up front, documents are encoded in chunks
+            # between other tasks and written on the snapshot thread
+            fh = await self._run_snapshot(self._create_snapshot, segment)
+            try:
+                written = 0
+                for collection, docs in self.data.items():
+                    ids = list(docs)
+                    for start in range(0, len(ids), self.chunk_size):
+                        lines = []
+                        for doc_id in ids[start:start + self.chunk_size]:
+                            doc = docs.get(doc_id)
+                            if doc is not None:
+                                lines.append(encode([collection, doc_id, doc]) + '\n')
+                        await self._run_snapshot(fh.write, ''.join(lines))
+                        written += len(lines)
+            except BaseException:
+                fh.close()
+                raise
+            await self._run_snapshot(self._finish_snapshot, fh, segment)
+            logger.info(f"Storage snapshot: {written} documents in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Storage snapshot failed: {e}")
+        finally:
+            self._snapshotter = None
+
+    async def get(self, collection, doc_id):
+        await self.open()
+        return self.data[collection].get(doc_id)
+
+    async def put(self, collection, doc_id, doc, durable=False):
+        await self.open()
+        self.data[collection][doc_id] = doc
+        await self._schedule(collection, doc_id, doc, durable)
+
+    async def delete(self, collection, doc_id, durable=False):
+        await self.open()
+        self.data[collection].pop(doc_id, None)
+        await self._schedule(collection, doc_id, None, durable)
+
+    async def find(self, collection, **filters):
+        await self.open()
+        return await super().find(collection, **filters)
+
+    async def count(self, collection, **filters):
+        await self.open()
+        return await super().count(collection, **filters)
+
+    async def scan(self, collection):
+        await self.open()
+        async for item in super().scan(collection):
+            yield item
+
+
+def create_storage(backend, path=None):
+    """Create storage backend by name"""
+    if backend == 'sqlite':
+        return SQLiteStorage(path)
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'journal':
+        return JournalStorage(path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# Fields holding datetimes in the legacy users_db / keys_db / payments_db dicts
+DUMP_DATETIME_FIELDS = ('registered', 'expiry', 'generated', 'date')
+DUMP_COLLECTIONS = {'users_db': 'users', 'keys_db': 'keys', 'payments_db': 'payments'}
+
+
+def _load_dump_doc(doc):
+    for field in DUMP_DATETIME_FIELDS:
+        if isinstance(doc.get(field), str):
+            doc[field] = datetime.fromisoformat(doc[field])
+    if doc.get('user_id') is not None:
+        doc['user_id'] = int(doc['user_id'])
+    return doc
+
+
+async def import_dump(storage, path):
+    """Import a JSON dump of users_db / keys_db / payments_db into storage"""
+    with open(path, encoding='utf-8') as fh:
+        dump = json.load(fh)
+
+    imported = {}
+    for dump_name, collection in DUMP_COLLECTIONS.items():
+        items = dump.get(dump_name, {})
+        for doc_id, doc in items.items():
+            if collection == 'users':
+                doc_id = int(doc_id)
+            await storage.put(collection, doc_id, _load_dump_doc(doc))
+        imported[collection] = len(items)
+    await storage.flush()
+    return imported
+
+
+async def _import_main(args):
+    storage = create_storage(args.backend, args.db)
+    await storage.open()
+    try:
+        imported = await import_dump(storage, args.dump)
+    finally:
+        await storage.close()
+    for collection, count in imported.items():
+        print(f"{collection}: {count}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VPN bot storage tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='import JSON dump of the legacy dicts')
+    import_parser.add_argument('dump')
+    import_parser.add_argument('--db', default='vpn_bot.db')
+    import_parser.add_argument('--backend', default='sqlite')
+    asyncio.run(_import_main(parser.parse_args()))
@@ -0,0 +1,23 @@
+import time
+
+from health import CircuitBreaker
+
+
+def test_half_open_breaker_allows_one_trial(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.acquire_trial()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.can_try()
+
+    now[0] += 30
+    # Checking is free, only acquire_trial takes the trial call
+    assert breaker.can_try() and breaker.can_try()
+    assert breaker.acquire_trial()
+    assert not breaker.can_try()
+    assert not breaker.acquire_trial()
+
+    breaker.record_success()
+    assert not breaker.is_open and breaker.acquire_trial() and breaker.acquire_trial()
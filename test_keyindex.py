@@ -0,0 +1,33 @@
+from keyindex import KeyIndex
+
+
+def test_advance_skips_replaced_entries():
+    dropped = []
+    index = KeyIndex(dropped.extend)
+    index.add('a', 1, 'EU', 10)
+    index.add('b', 1, 'US', 20)
+    # Renewed key: its old heap entry must not expire it
+    index.add('a', 1, 'EU', 30)
+    index.add('c', 2, 'EU', 15)
+    index.discard('c')
+
+    assert index.advance(20) == [('b', (1, 'US', 20))]
+    assert dropped == [('b', (1, 'US', 20))]
+    assert 'a' in index and index.next_expiry() == 30
+    assert index.user_key_count(2, 20) == 0
+
+    assert index.advance(30) == [('a', (1, 'EU', 30))]
+    assert len(index) == 0 and index.next_expiry() is None
+    assert index.user_key_count(1, 30) == 0
+
+
+def test_user_keys_page_by_expiry():
+    index = KeyIndex()
+    for expiry in (50, 10, 40, 20, 30):
+        index.add(f'k{expiry}', 1, 'EU', expiry)
+    index.add('other', 2, 'EU', 5)
+
+    assert index.user_keys_page(1, 0, 1, 2) == [('k20', 'EU', 20), ('k30', 'EU', 30)]
+    assert index.active_count(10) == 4
+    assert index.user_keys_page(1, 10, 0, 10) == [('k20', 'EU', 20), ('k30', 'EU', 30),
+                                                  ('k40', 'EU', 40), ('k50', 'EU', 50)]
@@ -0,0 +1,59 @@
+import asyncio
+import gc
+
+from locks import LockRegistry, SingleFlight
+
+
+def test_single_flight_joins_in_flight_calls():
+    async def scenario():
+        flight = SingleFlight(ttl=0)
+        started = []
+
+        async def work():
+            started.append(1)
+            await asyncio.sleep(0.01)
+            return 'key'
+
+        results = await asyncio.gather(*[flight.run('buy', work) for _ in range(3)])
+        assert results == ['key'] * 3 and started == [1]
+        # ttl=0 remembers nothing once finished
+        assert 'buy' not in flight
+        assert await flight.run('buy', work) == 'key' and len(started) == 2
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_keeps_results_not_errors():
+    async def scenario():
+        flight = SingleFlight(ttl=60)
+        calls = []
+
+        async def fail():
+            calls.append('fail')
+            raise ValueError
+
+        async def work():
+            calls.append('work')
+            return 1
+
+        for _ in range(2):
+            try:
+                await flight.run('a', fail)
+            except ValueError:
+                pass
+        assert await flight.run('a', work) == 1
+        assert await flight.run('a', work) == 1
+        assert 'a' in flight and calls == ['fail', 'fail', 'work']
+
+    asyncio.run(scenario())
+
+
+def test_lock_registry_drops_idle_locks():
+    async def scenario():
+        locks = LockRegistry()
+        async with locks[1]:
+            assert locks[1].locked() and len(locks) == 1
+        gc.collect()
+        assert len(locks) == 0
+
+    asyncio.run(scenario())
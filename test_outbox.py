@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from telethon.errors import FloodWaitError
+
+from outbox import BROADCAST, KEY_DELIVERY, NOTIFICATION, Outbox
+
+
+class FakeClient:
+    def __init__(self, flood_waits=0):
+        self.sent = []
+        self.times = []
+        self.flood_waits = flood_waits
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.flood_waits:
+            self.flood_waits -= 1
+            raise FloodWaitError(request=None, capture=0)
+        self.sent.append((chat_id, text))
+        self.times.append(time.monotonic())
+        return text
+
+
+def test_per_chat_fifo_and_priority():
+    async def scenario():
+        client = FakeClient()
+        outbox = Outbox(client, rate=1000, workers=1, chat_interval=0)
+        futures = [
+            outbox.send_message(1, 'a', priority=BROADCAST),
+            outbox.send_message(2, 'x', priority=BROADCAST),
+            outbox.send_message(1, 'b', priority=NOTIFICATION),
+            outbox.send_message(3, 'key', priority=KEY_DELIVERY),
+        ]
+        assert len(outbox) == 4
+        outbox.start()
+        assert await asyncio.gather(*futures) == ['a', 'x', 'b', 'key']
+        assert client.sent[0] == (3, 'key')
+        sent_to_1 = [text for chat_id, text in client.sent if chat_id == 1]
+        assert sent_to_1 == ['a', 'b']
+        assert len(outbox) == 0
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+
+
+def test_urgent_call_moves_waiting_chat_up():
+    async def scenario():
+        client = FakeClient()
+        outbox = Outbox(client, rate=1000, workers=1, chat_interval=0)
+        futures = [
+            outbox.send_message(2, 'b', priority=BROADCAST),
+            outbox.send_message(1, 'a', priority=BROADCAST),
+            outbox.send_message(3, 'n', priority=NOTIFICATION),
+            outbox.send_message(1, 'key', priority=KEY_DELIVERY),
+        ]
+        outbox.start()
+        await asyncio.gather(*futures)
+        assert [text for _, text in client.sent] == ['a', 'key', 'n', 'b']
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+
+def test_chat_interval():
+    async def scenario():
+        client = FakeClient()
+        outbox = Outbox(client, rate=1000, workers=2, chat_interval=0.05)
+        outbox.start()
+        futures = [outbox.send_message(1, text) for text in ('a', 'b', 'c')]
+        futures.append(outbox.send_message(2, 'x'))
+        await asyncio.gather(*futures)
+        assert client.sent[:2] == [(1, 'a'), (2, 'x')]
+        times = [sent_at for (chat_id, _), sent_at in zip(client.sent, client.times) if chat_id == 1]
+        assert all(later - earlier >= 0.05 for earlier, later in zip(times, times[1:]))
+        assert len(outbox) == 0
+        await asyncio.sleep(0.06)
+        assert not outbox._chats
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+
+def test_flood_wait_retries_head_of_chat():
+    async def scenario():
+        client = FakeClient(flood_waits=1)
+        outbox = Outbox(client, rate=1000, workers=2, chat_interval=0)
+        outbox.start()
+        futures = [outbox.send_message(1, text) for text in ('a', 'b', 'c')]
+        assert await asyncio.gather(*futures) == ['a', 'b', 'c']
+        assert client.sent == [(1, 'a'), (1, 'b'), (1, 'c')]
+        assert outbox.flood_waits == 1
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+
+def test_gives_up_after_max_attempts():
+    async def scenario():
+        outbox = Outbox(FakeClient(flood_waits=5), rate=1000, max_attempts=2, chat_interval=0)
+        outbox.start()
+        try:
+            await outbox.send_message(1, 'a')
+        except FloodWaitError:
+            pass
+        else:
+            assert False, 'FloodWaitError expected'
+        assert outbox.flood_waits == 2
+        await outbox.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+import asyncio
+
+from payments import PaymentService, WebhookProvider
+from storage import MemoryStorage
+
+
+class FakeRequest:
+    def __init__(self, data, secret=''):
+        self.headers = {'X-Webhook-Secret': secret} if secret else {}
+        self._data = data
+
+    async def json(self):
+        return self._data
+
+
+def make_service(**kwargs):
+    fulfilled = []
+
+    async def fulfill(payment_id, payment):
+        fulfilled.append(payment_id)
+
+    service = PaymentService(MemoryStorage(), WebhookProvider('https://example.com/pay/'), fulfill,
+                             webhook_port=0, **kwargs)
+    return service, fulfilled
+
+
+def test_webhook_requires_secret():
+    async def scenario():
+        service, _ = make_service()
+        payment_id, _ = await service.create(1, 'EU', 30, 100)
+        body = {'payment_id': payment_id, 'status': 'paid', 'amount': 100}
+        response = await service._handle_webhook(FakeRequest(body, secret='anything'))
+        assert response.status == 403
+        assert not (await service.storage.get('payments', payment_id))['paid']
+
+    asyncio.run(scenario())
+
+
+def test_webhook_checks_secret_and_amount():
+    async def scenario():
+        service, _ = make_service(webhook_secret='s3cret')
+        payment_id, _ = await service.create(1, 'EU', 30, 100)
+
+        body = {'payment_id': payment_id, 'status': 'paid', 'amount': 100}
+        assert (await service._handle_webhook(FakeRequest(body, secret='wrong'))).status == 403
+
+        body['amount'] = 1
+        assert (await service._handle_webhook(FakeRequest(body, secret='s3cret'))).status == 400
+        assert not (await service.storage.get('payments', payment_id))['paid']
+
+        body['amount'] = '100.00'
+        assert (await service._handle_webhook(FakeRequest(body, secret='s3cret'))).status == 200
+        assert (await service.storage.get('payments', payment_id))['paid']
+
+    asyncio.run(scenario())
+
+
+def test_confirm_is_idempotent():
+    async def scenario():
+        service, fulfilled = make_service(workers=2)
+        payment_id, _ = await service.create(1, 'EU', 30, 100)
+        await service.start()
+        assert await service.confirm(payment_id)
+        assert await service.confirm(payment_id)
+        await asyncio.sleep(0.05)
+        assert fulfilled == [payment_id]
+        assert (await service.storage.get('payments', payment_id))['completed']
+        assert not await service.confirm(payment_id)
+        assert service.pending_count == 0 and service.pending_revenue == 0
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_unpaid_payment_expires():
+    async def scenario():
+        expired = []
+
+        async def on_expire(payment_id, payment):
+            expired.append(payment_id)
+
+        service, fulfilled = make_service(ttl=0, poll_interval=60, on_expire=on_expire)
+        payment_id, _ = await service.create(1, 'EU', 30, 100)
+        assert service.pending_revenue == 100
+        await service.start()
+        await asyncio.sleep(0.05)
+        assert expired == [payment_id] and fulfilled == []
+        assert await service.storage.get('payments', payment_id) is None
+        assert service.pending_count == 0 and service.pending_revenue == 0
+        # The same purchase opens a fresh invoice
+        assert (await service.create(1, 'EU', 30, 100))[0] != payment_id
+        await service.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import asyncio
+
+from router import CallbackRouter
+
+
+def make_router():
+    router = CallbackRouter()
+
+    @router.route('pay', str, int)
+    async def pay(event, server, days):
+        return 'pay', server, days
+
+    @router.route('pay_balance', str, int)
+    async def pay_balance(event, server, days):
+        return 'pay_balance', server, days
+
+    @router.route('back')
+    async def back(event):
+        return 'back'
+
+    return router, pay, pay_balance, back
+
+
+def test_longest_route_wins():
+    router, pay, pay_balance, back = make_router()
+    assert router.resolve(b'pay_balance_EU_30') == (pay_balance, ['EU', 30])
+    assert router.resolve(b'pay_EU_30') == (pay, ['EU', 30])
+    assert router.resolve(b'back') == (back, [])
+
+
+def test_bad_callback_data():
+    router, *_ = make_router()
+    assert router.resolve(b'pay_EU') is None
+    assert router.resolve(b'pay_EU_month') is None
+    assert router.resolve(b'back_1') is None
+    assert router.resolve(b'unknown_1') is None
+    assert router.resolve(b'\xff\xfe') is None
+
+
+def test_dispatch_answers_unknown_data():
+    class Event:
+        data = b'unknown'
+        answered = False
+
+        async def answer(self):
+            self.answered = True
+
+    router, *_ = make_router()
+    event = Event()
+    asyncio.run(router.dispatch(event))
+    assert event.answered
@@ -0,0 +1,31 @@
+import os
+import re
+
+from settings import load_settings
+
+README = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README.md')
+
+
+def readme_configs():
+    """config.ini samples from README, with placeholders filled in"""
+    with open(README, encoding='utf-8') as fh:
+        text = fh.read()
+    samples = [block for block in re.findall(r'```ini\n(.*?)```', text, re.S) if '[Telegram]' in block]
+    assert samples
+    for sample in samples:
+        sample = re.sub(r'(?m)^API_ID = .*$', 'API_ID = 12345', sample)
+        yield re.sub(r'(?m)^admin_ids = .*$', 'admin_ids = 1, 2  # comma separated', sample)
+
+
+def test_readme_sample_loads(tmp_path):
+    for i, sample in enumerate(readme_configs()):
+        path = tmp_path / f'config{i}.ini'
+        path.write_text(sample, encoding='utf-8')
+        settings = load_settings(str(path))
+        assert settings.api_id == 12345
+        assert settings.admin_ids == [1, 2]
+        assert settings.outline.connect_timeout == 3
+        assert settings.outline.servers['EU']['cert'] == '/path/to/cert.crt'
+        assert 'US' not in settings.outline.servers
+        assert settings.payments.provider == 'webhook'
+        assert settings.storage_backend == 'sqlite'
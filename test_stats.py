@@ -0,0 +1,34 @@
+import asyncio
+from datetime import datetime
+
+from stats import MIGRATIONS, Stats
+from storage import MemoryStorage
+
+
+def test_bootstrap_then_load():
+    async def scenario():
+        storage = MemoryStorage()
+        await storage.put('users', 1, {'registered': datetime(2026, 3, 1, 10), 'purchases': 2})
+        await storage.put('users', 2, {'registered': datetime(2026, 3, 2, 10), 'purchases': 0})
+        await storage.put('payments', 'P1', {'date': datetime(2026, 3, 1, 12), 'server': 'EU',
+                                             'amount': 100, 'completed': True})
+        await storage.put('payments', 'P2', {'date': datetime(2026, 3, 1, 13), 'server': 'EU',
+                                             'amount': 300, 'completed': False})
+        await storage.put('stats', MIGRATIONS, {'referrals': True})
+
+        stats = Stats(storage)
+        await stats.load()
+        assert stats.total == {'users': 2, 'sales': 2, 'revenue': 100, 'abandoned': 0, 'abandoned_amount': 0}
+        day = stats.days['2026-03-01']
+        assert day['registrations'] == 1 and day['sales'] == 1
+        assert day['servers'] == {'EU': {'sales': 1, 'revenue': 100}}
+
+        await stats.record_sale('US', 50, when=datetime(2026, 3, 2, 9))
+        # A restart loads the saved rollups instead of rebuilding them
+        reloaded = Stats(storage)
+        await reloaded.load()
+        assert reloaded.total == stats.total
+        assert reloaded.days == stats.days
+        assert MIGRATIONS not in reloaded.days
+
+    asyncio.run(scenario())
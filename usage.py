@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+
+class UsageTable:
+    """Transferred bytes per key in a flat array.
+
+    Every tracked key owns a slot of an `array('q')`; the access key and
+    the (server, key_id) pair Outline reports map to the slot. Slots of
+    discarded keys are reused, so the table stays as large as the set of
+    active keys. Totals per server cover every key the server reports,
+    including pooled and bulk keys that are not tracked here.
+    """
+
+    def __init__(self):
+        self._bytes = array('q')
+        self._slots = {}      # access key -> slot
+        self._ids = {}        # (server, key_id) -> slot
+        self._owners = []     # slot -> (access key, (server, key_id)) or None
+        self._free = []
+        self.servers = {}     # server -> {'keys': n, 'bytes': total, 'synced': timestamp}
+
+    def __len__(self):
+        return len(self._slots)
+
+    def track(self, key, server, key_id):
+        """Start accounting traffic of a key"""
+        self.discard(key)
+        ident = (server, str(key_id))
+        if self._free:
+            slot = self._free.pop()
+            self._bytes[slot] = 0
+            self._owners[slot] = (key, ident)
+        else:
+            slot = len(self._bytes)
+            self._bytes.append(0)
+            self._owners.append((key, ident))
+        self._slots[key] = slot
+        self._ids[ident] = slot
+
+    def discard(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        del self._ids[self._owners[slot][1]]
+        self._owners[slot] = None
+        self._free.append(slot)
+
+    def get(self, key):
+        """Bytes transferred by a key, None if it isn't tracked"""
+        slot = self._slots.get(key)
+        return None if slot is None else self._bytes[slot]
+
+    def merge(self, server, transferred):
+        """Apply one server's {key_id: bytes} report"""
+        ids = self._ids
+        data = self._bytes
+        total = 0
+        for key_id, value in transferred.items():
+            total += value
+            slot = ids.get((server, str(key_id)))
+            if slot is not None:
+                data[slot] = value
+        self.servers[server] = {'keys': len(transferred), 'bytes': total, 'synced': time.time()}
+
+
+class UsageSync:
+    """Pulls transfer metrics of all keys with one call per server"""
+
+    def __init__(self, transport, table, servers, is_available, interval=300):
+        self.transport = transport
+        self.table = table
+        self.servers = servers
+        self.is_available = is_available
+        self.interval = interval
+
+    async def sync_server(self, server):
+        try:
+            status, body = await self.transport.post(server, {'method': 'get_transfer_metrics'})
+            if status != 200:
+                raise ValueError(f"status {status}")
+            transferred = body['result']['bytesTransferredByUserId']
+        except Exception as e:
+            logger.warning("Usage sync failed for %s: %s", server, e, extra={'server': server})
+            return False
+        self.table.merge(server, transferred)
+        return True
+
+    async def sync(self):
+        """Sync every available server once"""
+        servers = [server for server in self.servers if self.is_available(server)]
+        results = await asyncio.gather(*[self.sync_server(server) for server in servers])
+        return sum(results)
+
+    async def run(self):
+        while True:
+            synced = await self.sync()
+            logger.debug("Usage synced from %d servers, %d keys tracked", synced, len(self.table))
+            await asyncio.sleep(self.interval)